@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the Flair JSON:API used by the benchmarks.  Serves a
+synthetic home of one structure with rooms, pucks, vents and their current
+readings, in the shapes flair_api.Client.handle_resp expects.  Latency,
+error rate and page size are configurable.
+
+    python3 bench/fake_flair.py --devices 50 --latency 0.05 --port 8080
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs, urlencode
+except ImportError:
+    raise SystemExit('fake_flair requires Python 3.7 or later')
+
+DEVICES_PER_ROOM = 3
+TIMESTAMP = '%Y-%m-%dT%H:%M:%S.000000+00:00'
+
+
+def now():
+    return time.strftime(TIMESTAMP, time.gmtime())
+
+
+class FakeHome(object):
+    '''
+    The synthetic data.  Every room gets a puck and vents for the rest of
+    its share of devices; ids are unique across all types.
+    '''
+    def __init__(self, devices):
+        self.next_id = 1
+        self.resources = {}
+        self.children = {}
+        self.structure = self.add('structures', {
+            'name': 'Bench Home',
+            'is-active': True,
+            'home': True,
+            'mode': 'manual',
+            'home-away-mode': 'Manual',
+            'set-point-mode': 'Home Evenness For Active Rooms Flair Setpoint',
+            'set-point-temperature-c': 21.0,
+            'created-at': now()})
+        rooms = max(1, (devices + DEVICES_PER_ROOM - 1) // DEVICES_PER_ROOM)
+        for r in range(rooms):
+            room = self.add('rooms', {
+                'name': 'Room {}'.format(r + 1),
+                'active': True,
+                'current-temperature-c': 20.0 + r % 5,
+                'current-humidity': 40.0,
+                'set-point-c': 21.0,
+                'created-at': now()}, parent=self.structure)
+            share = min(DEVICES_PER_ROOM, devices - r * DEVICES_PER_ROOM)
+            for d in range(share):
+                if d == 0:
+                    self.add('pucks', {'name': 'Puck {}'.format(r + 1), 'inactive': False}, parent=room)
+                else:
+                    self.add('vents', {'name': 'Vent {}-{}'.format(r + 1, d), 'inactive': False}, parent=room)
+
+    def add(self, type_, attributes, parent=None):
+        resource = {'type': type_, 'id': str(self.next_id), 'attributes': attributes}
+        self.next_id += 1
+        self.resources[(type_, resource['id'])] = resource
+        if parent is not None:
+            self.children.setdefault((parent['type'], parent['id'], type_), []).append(resource)
+        return resource
+
+    def related(self, resource, rel):
+        return self.children.get((resource['type'], resource['id'], rel), [])
+
+    def reading_type(self, device):
+        return 'vent-sensor-readings' if device['type'] == 'vents' else 'sensor-readings'
+
+    def reading(self, device):
+        if device['type'] == 'vents':
+            attributes = {'duct-temperature-c': round(random.uniform(15, 40), 2),
+                          'duct-pressure': round(random.uniform(90, 110), 2),
+                          'percent-open': 100,
+                          'system-voltage': round(random.uniform(2.8, 3.2), 2),
+                          'rssi': random.randint(-90, -40),
+                          'created-at': now()}
+        else:
+            attributes = {'room-temperature-c': round(random.uniform(18, 24), 2),
+                          'humidity': random.randint(30, 60),
+                          'system-voltage': round(random.uniform(2.8, 3.2), 2),
+                          'rssi': random.randint(-90, -40),
+                          'created-at': now()}
+        return {'type': self.reading_type(device), 'id': 'r' + device['id'], 'attributes': attributes}
+
+    def document(self, resource, with_data=()):
+        '''
+        A resource in JSON:API form with links for its relationships, plus
+        data for the ones named in with_data.
+        '''
+        base = '/api/{}/{}'.format(resource['type'], resource['id'])
+        rels = {}
+        names = {'structures': ('rooms',), 'rooms': ('pucks', 'vents'),
+                 'pucks': ('current-reading',), 'vents': ('current-reading',)}
+        for rel in names.get(resource['type'], ()):
+            rels[rel] = {'links': {'self': base + '/relationships/' + rel,
+                                   'related': base + '/' + rel}}
+            if rel in with_data:
+                if rel == 'current-reading':
+                    rels[rel]['data'] = {'type': self.reading_type(resource), 'id': 'r' + resource['id']}
+                else:
+                    rels[rel]['data'] = [{'type': r['type'], 'id': r['id']} for r in self.related(resource, rel)]
+        return {'type': resource['type'], 'id': resource['id'],
+                'attributes': dict(resource['attributes']),
+                'relationships': rels}
+
+
+class FakeFlairServer(object):
+    def __init__(self, devices, latency=0.0, errors=0.0, error_status=503,
+                 page_size=50, host='127.0.0.1', port=0):
+        self.home = FakeHome(devices)
+        self.latency = latency
+        self.errors = errors
+        self.error_status = error_status
+        self.page_size = page_size
+        self.requests = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(FlairHandler):
+            fake = server
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake-flair', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FlairHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the client's connection pool is exercised as in
+    # production.
+    protocol_version = 'HTTP/1.1'
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers={}):
+        data = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/vnd.api+json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def begin(self):
+        '''
+        Count the request, read its body, then apply the latency and
+        error injection.  Returns the body, None if an error was sent.
+        '''
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        fake = self.fake
+        with fake.lock:
+            fake.requests += 1
+        if fake.latency:
+            time.sleep(fake.latency)
+        if fake.errors and random.random() < fake.errors:
+            self.send_json(fake.error_status, {'errors': [{'status': str(fake.error_status)}]},
+                           {'Retry-After': '0'} if fake.error_status in (429, 503) else {})
+            return None
+        return body
+
+    def do_POST(self):
+        if self.begin() is None:
+            return
+        if urlparse(self.path).path.rstrip('/') == '/oauth/token':
+            self.send_json(200, {'access_token': 'bench-token', 'expires_in': 3600, 'token_type': 'Bearer'})
+        else:
+            self.send_json(404, {'errors': [{'status': '404'}]})
+
+    def do_PATCH(self):
+        body = self.begin()
+        if body is None:
+            return
+        body = json.loads(body or b'{}')
+        parts = urlparse(self.path).path.strip('/').split('/')
+        resource = self.fake.home.resources.get(tuple(parts[1:3])) if len(parts) == 3 else None
+        if resource is None:
+            self.send_json(404, {'errors': [{'status': '404'}]})
+            return
+        resource['attributes'].update(body.get('data', {}).get('attributes', {}))
+        self.send_json(200, {'data': self.fake.home.document(resource)})
+
+    def do_GET(self):
+        if self.begin() is None:
+            return
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        home = self.fake.home
+
+        if parts == ['api']:
+            self.send_json(200, {'links': {t: {'self': '/api/' + t, 'type': t}
+                                           for t in ('structures', 'rooms', 'pucks', 'vents')}})
+            return
+
+        if len(parts) == 2 and parts[0] == 'api':
+            items = [r for (t, _), r in home.resources.items() if t == parts[1]]
+            self.send_page(url.path, query, items, ())
+            return
+
+        resource = home.resources.get((parts[1], parts[2])) if len(parts) >= 3 else None
+        if resource is None:
+            self.send_json(404, {'errors': [{'status': '404'}]})
+        elif len(parts) == 3:
+            self.send_json(200, {'data': home.document(resource)})
+        elif parts[3] == 'current-reading':
+            self.send_json(200, {'data': home.reading(resource)})
+        else:
+            includes = query.get('include', [''])[0].split(',')
+            self.send_page(url.path, query, home.related(resource, parts[3]),
+                           [i for i in includes if i])
+
+    def send_page(self, path, query, items, includes):
+        '''
+        One page of a collection, with the vents/pucks and their readings
+        in included when asked for.
+        '''
+        home = self.fake.home
+        size = int(query.get('page[size]', [self.fake.page_size])[0])
+        number = int(query.get('page[number]', ['1'])[0])
+        page = items[(number - 1) * size:number * size]
+
+        nested = set(i.split('.')[0] for i in includes)
+        data = [home.document(r, with_data=nested) for r in page]
+        included = []
+        for resource in page:
+            for rel in nested:
+                for device in home.related(resource, rel):
+                    deep = ('current-reading',) if rel + '.current-reading' in includes else ()
+                    included.append(home.document(device, with_data=deep))
+                    if deep:
+                        included.append(home.reading(device))
+
+        meta = {'total': len(items)}
+        if number * size < len(items):
+            params = {'page[number]': number + 1, 'page[size]': size}
+            if includes:
+                params['include'] = ','.join(includes)
+            meta['next'] = path + '?' + urlencode(params)
+        body = {'data': data, 'meta': meta}
+        if included:
+            body['included'] = included
+        self.send_json(200, body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in Flair API')
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--errors', type=float, default=0.0, help='fraction of requests that fail')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    server = FakeFlairServer(args.devices, args.latency, args.errors, args.error_status,
+                             args.page_size, port=args.port)
+    print('Serving {} devices on {}'.format(args.devices, server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the node server against the local stand-in server in
+fake_flair.py.  For each home size it runs the Controller's discovery of
+the account and the poll cycles the scheduler runs, through the real
+Controller and node classes with a minimal Polyglot stand-in: wall time,
+requests sent, status messages sent to Polyglot and peak memory
+allocated by Python.
+
+    python3 bench/run_bench.py --sizes 5,50,500 --latency 0.02 --cycles 3
+
+Needs the node server's requirements (udi_interface, requests) installed.
+Snapshots the Controller writes go to a temporary directory.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flair_accounts import parse_accounts
+from flair_poly import BATCH_MODES
+from flair_poly import Controller
+from flair_poly import FlairPuck
+from flair_poly import FlairVent
+from fake_flair import FakeFlairServer
+
+
+class Notices(dict):
+    def delete(self, key):
+        self.pop(key, None)
+
+
+class Poly(object):
+    '''
+    The parts of udi_interface.Interface the Controller and its nodes
+    use.  Status messages are counted, not sent anywhere.
+    '''
+    START = CUSTOMPARAMS = POLL = None
+
+    def __init__(self):
+        self.node_map = {}
+        self.Notices = Notices()
+        self.messages = 0
+
+    def subscribe(self, *args):
+        pass
+
+    def ready(self):
+        pass
+
+    def db_getNodeDrivers(self, address):
+        return []
+
+    def addNode(self, node):
+        self.node_map[node.address] = node
+        return node
+
+    def getNode(self, address):
+        return self.node_map.get(address)
+
+    def nodes(self):
+        return list(self.node_map.values())
+
+    def send(self, message, kind):
+        self.messages += 1
+
+
+def measure(fn, metrics, poly):
+    start_requests = metrics.request_count
+    start_messages = poly.messages
+    tracemalloc.reset_peak()
+    start = time.monotonic()
+    fn()
+    elapsed = time.monotonic() - start
+    _, peak = tracemalloc.get_traced_memory()
+    return elapsed, metrics.request_count - start_requests, poly.messages - start_messages, peak
+
+
+def bench(devices, args):
+    server = FakeFlairServer(devices, latency=args.latency, errors=args.errors,
+                             page_size=args.page_size).start()
+    cwd = os.getcwd()
+    workdir = tempfile.TemporaryDirectory()
+    os.chdir(workdir.name)
+    poly = Poly()
+    controller = Controller(poly, 'controller', 'controller', 'Flair')
+    try:
+        controller.api_root = server.url
+        controller.pool_size = args.workers
+        controller.update_workers = args.workers
+        controller.rate_limit = 0
+        controller.async_enabled = args.async_client
+        controller.batch_drivers = args.batch_drivers
+        controller.setAccounts(parse_accounts({'client_id': 'bench', 'client_secret': 'bench'}))
+        account = controller.accounts['']
+        account.get_client().oauth_token()
+
+        tracemalloc.start()
+        t, requests, messages, peak = measure(lambda: controller.discoverAccount(account), controller.metrics, poly)
+        found = len([node for node in poly.nodes() if isinstance(node, (FlairVent, FlairPuck))])
+        rows = [('discovery', found, t, requests, messages, peak)]
+
+        nodes = controller.scheduledNodes()
+        for cycle in range(args.cycles):
+            t, requests, messages, peak = measure(lambda: controller.runCycle(nodes), controller.metrics, poly)
+            rows.append(('poll {}'.format(cycle + 1), found, t, requests, messages, peak))
+        tracemalloc.stop()
+    finally:
+        controller.delete()
+        os.chdir(cwd)
+        workdir.cleanup()
+        server.stop()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Flair client against a local stand-in API')
+    parser.add_argument('--sizes', default='5,50,500', help='devices per home, comma separated')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the server adds to every request')
+    parser.add_argument('--errors', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--async-client', action='store_true', help='refresh structures on the asyncio client')
+    parser.add_argument('--batch-drivers', choices=BATCH_MODES, default='node')
+    args = parser.parse_args()
+
+    print('{:>7} {:<10} {:>8} {:>10} {:>9} {:>9} {:>10}'.format(
+        'devices', 'phase', 'found', 'wall ms', 'requests', 'messages', 'peak KiB'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        for phase, found, elapsed, requests, messages, peak in bench(size, args):
+            print('{:>7} {:<10} {:>8} {:>10.1f} {:>9} {:>9} {:>10.1f}'.format(
+                size, phase, found, elapsed * 1000, requests, messages, peak / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import os
+import re
+import udi_interface
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flair_api import Client
+from flair_api import CircuitBreaker
+from flair_api import DEFAULT_BREAKER_THRESHOLD
+from flair_api import DEFAULT_POOL_SIZE
+from flair_api import DEFAULT_TIMEOUT
+from flair_api import RateLimiter
+from flair_api import ResponseCache
+from flair_async import AsyncClient
+
+LOGGER = udi_interface.LOGGER
+
+CREDENTIAL_PARAM = re.compile(r'^client_(id|secret)(?:_(\w+))?$')
+
+
+def parse_accounts(params):
+    '''
+    Credentials from the custom parameters: client_id and client_secret
+    for the first account, client_id_N and client_secret_N for more.
+    Returns {key: (client_id, client_secret)} in key order, the first
+    account's key is ''.  Missing halves are returned as "".
+    '''
+    accounts = {}
+    for name, value in params.items():
+        match = CREDENTIAL_PARAM.match(name)
+        if match is None:
+            continue
+        key = match.group(2) or ''
+        if key and not key.isdigit():
+            LOGGER.error('Invalid credentials parameter {}, expected {}_N with N a number'.format(
+                name, 'client_' + match.group(1)))
+            continue
+        client_id, client_secret = accounts.get(key, ('', ''))
+        if match.group(1) == 'id':
+            client_id = value or ''
+        else:
+            client_secret = value or ''
+        accounts[key] = (client_id, client_secret)
+    return OrderedDict(sorted(accounts.items(), key=lambda a: int(a[0] or 0)))
+
+
+class Account(object):
+    '''
+    One set of Flair credentials and what belongs to it: the API clients
+    with their token, a rate budget, a circuit breaker, a bounded pool of
+    update workers and the index of its nodes.  The first account keeps
+    unprefixed node addresses, the others are prefixed with a and their
+    key so accounts sharing a structure still get a node each.
+    '''
+    def __init__(self, key, client_id, client_secret, metrics=None, api_root_cache=None):
+        self.key = key
+        self.prefix = 'a' + key if key else ''
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.metrics = metrics
+        self.api_root_cache = api_root_cache
+        self.api_root = None
+        self.pool_size = DEFAULT_POOL_SIZE
+        self.timeout = DEFAULT_TIMEOUT
+        self.workers = 0
+        self.executor = None
+        self.rate_limiter = RateLimiter()
+        self.breaker = CircuitBreaker()
+        self.cache_size = 0
+        self.cache_ttls = {}
+        self.client = None
+        self.client_config = None
+        self.cache_config = None
+        self.async_client = None
+        self.async_config = None
+        # Node address of each Flair (type, id), see topology_index().
+        self.index = {}
+
+    def __str__(self):
+        return 'account ' + (self.key or '1')
+
+    def snapshot(self, path):
+        '''
+        Where this account's copy of a per-account file goes.
+        '''
+        if not self.key:
+            return path
+        base, ext = os.path.splitext(path)
+        return '{}_{}{}'.format(base, self.key, ext)
+
+    def configure(self, client_id, client_secret, api_root, pool_size, workers, rate, cache_size, cache_ttls,
+                  breaker_threshold=DEFAULT_BREAKER_THRESHOLD, timeout=DEFAULT_TIMEOUT):
+        self.breaker.threshold = breaker_threshold
+        self.timeout = timeout
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.api_root = api_root
+        self.pool_size = pool_size
+        self.cache_size = cache_size
+        self.cache_ttls = cache_ttls
+        self.rate_limiter.set_rate(rate)
+        self.set_workers(workers)
+
+    def set_workers(self, workers):
+        if workers == self.workers and self.executor is not None:
+            return
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='update' + (self.key and '_' + self.key))
+
+    def config(self):
+        return (self.client_id, self.client_secret, self.api_root, max(self.pool_size, self.workers), self.timeout)
+
+    def get_client(self):
+        config = self.config()
+        if self.client is None or self.client_config != config:
+            if self.client is not None:
+                self.client.close()
+            self.client = Client(client_id=self.client_id,
+                                 client_secret=self.client_secret,
+                                 api_root=self.api_root,
+                                 pool_size=config[3],
+                                 api_root_cache=self.api_root_cache,
+                                 rate_limiter=self.rate_limiter,
+                                 metrics=self.metrics,
+                                 breaker=self.breaker,
+                                 timeout=self.timeout)
+            self.client_config = config
+            self.cache_config = None
+        cache = (self.cache_size, sorted(self.cache_ttls.items()))
+        if self.cache_config != cache:
+            self.client.response_cache = ResponseCache(self.cache_size, self.cache_ttls) if self.cache_size else None
+            self.cache_config = cache
+        return self.client
+
+    def get_async_client(self, loop):
+        '''
+        The asyncio client of this account, run on loop.  Raises
+        ImportError when httpx is not installed.
+        '''
+        client = self.get_client()
+        config = self.config()
+        if self.async_client is None or self.async_config != config:
+            if self.async_client is not None:
+                loop.run(self.async_client.close())
+            self.async_client = AsyncClient(client_id=self.client_id,
+                                            client_secret=self.client_secret,
+                                            api_root=self.api_root,
+                                            pool_size=config[3],
+                                            in_flight=self.workers,
+                                            api_root_cache=self.api_root_cache,
+                                            rate_limiter=self.rate_limiter,
+                                            metrics=self.metrics,
+                                            breaker=self.breaker,
+                                            timeout=self.timeout)
+            self.async_config = config
+        self.async_client.response_cache = client.response_cache
+        return self.async_client
+
+    def ready(self):
+        '''
+        Whether the account's nodes should be refreshed.  While the API is
+        failing they keep their last values; when the breaker's wait is
+        over a probe request decides.
+        '''
+        if self.breaker.due() and self.get_client().probe():
+            return True
+        return self.breaker.closed()
+
+    def submit(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    def close(self, loop=None):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+        if self.async_client is not None and loop is not None:
+            loop.run(self.async_client.close())
+        self.async_client = None
@@ -1,11 +1,36 @@
+import json
+import logging
+import os
+import random
 import requests
+import threading
+import time
 import udi_interface
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 try:
     from urllib.parse import urljoin
 except ImportError:
     from urlparse import urljoin
 
+try:
+    from email.utils import parsedate_to_datetime
+except ImportError:
+    parsedate_to_datetime = None
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        json_loads = json.loads
+
 LOGGER = udi_interface.LOGGER
 
 DEFAULT_CLIENT_HEADERS = {
@@ -13,6 +38,70 @@ DEFAULT_CLIENT_HEADERS = {
     'Content-Type': 'application/json'
 }
 
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TOKEN_MARGIN = 60
+DEFAULT_API_ROOT_TTL = 7 * 24 * 3600
+DEFAULT_CACHE_SIZE = 256
+DEFAULT_RATE_LIMIT = 5
+DEFAULT_MAX_RETRIES = 4
+# Seconds to connect and to wait for an answer before a request fails.
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_TIMEOUT = (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+RETRY_STATUS = (429, 503)
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 60
+DEFAULT_BREAKER_THRESHOLD = 5
+BREAKER_BASE_DELAY = 10
+BREAKER_MAX_DELAY = 600
+
+# Request priority classes, lower goes first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_NAMES = ('interactive', 'background')
+
+_priority = threading.local()
+
+
+def request_priority():
+    '''
+    Priority class of requests sent from the current thread.
+    '''
+    return getattr(_priority, 'value', PRIORITY_BACKGROUND)
+
+
+@contextmanager
+def interactive():
+    '''
+    Send the requests made inside the block ahead of queued polling.
+    '''
+    previous = request_priority()
+    _priority.value = PRIORITY_INTERACTIVE
+    try:
+        yield
+    finally:
+        _priority.value = previous
+
+
+def parse_timestamp(value):
+    '''
+    Seconds since the epoch for an API timestamp such as
+    2025-01-21T23:00:18.335236+00:00, None if it can't be parsed.
+    '''
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def updated_at(attributes):
+    '''
+    When a resource was last changed according to its attributes, from
+    updated-at or for readings created-at, None if they have neither.
+    '''
+    value = attributes.get('updated-at') or attributes.get('created-at')
+    return parse_timestamp(value) if value else None
+
 
 def relationship_data(data):
     return [m.to_relationship() for m in data] \
@@ -42,17 +131,323 @@ class ApiError(Exception):
             str(self.status_code) + ">"
 
 
+class CircuitOpenError(ApiError):
+    '''
+    Raised instead of sending a request while the API is unreachable.
+    An ApiError, so callers handle it like a failed request.
+    '''
+    def __init__(self, breaker):
+        self.status_code = 503
+        self.body = ''
+        self.json = None
+        self.retry_at = breaker.retry_at
+
+
+class CircuitBreaker(object):
+    '''
+    Stops sending to an API that keeps failing.  After threshold
+    requests in a row go unanswered or get a 5xx, it opens and requests
+    fail fast with CircuitOpenError.  Once the delay has passed a single
+    request goes through as a probe: an answer closes the breaker, a
+    failure opens it again for twice as long, up to max_delay.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    PROBING = 'probing'
+
+    def __init__(self, threshold=DEFAULT_BREAKER_THRESHOLD, delay=BREAKER_BASE_DELAY,
+                 max_delay=BREAKER_MAX_DELAY):
+        self.threshold = threshold
+        self.delay = delay
+        self.max_delay = max_delay
+        self.state = self.CLOSED
+        self.failures = 0
+        self.wait = delay
+        self.retry_at = 0
+        self.lock = threading.Lock()
+
+    def closed(self):
+        return self.state == self.CLOSED
+
+    def due(self):
+        '''
+        Whether the next request would be let through as a probe.
+        '''
+        return self.state != self.CLOSED and time.monotonic() >= self.retry_at
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if now < self.retry_at:
+                return False
+            # Let one probe through.  Should it never report back, the
+            # next one goes after another wait.
+            self.state = self.PROBING
+            self.retry_at = now + self.wait
+            return True
+
+    def success(self):
+        if self.state == self.CLOSED and not self.failures:
+            return
+        with self.lock:
+            if self.state != self.CLOSED:
+                LOGGER.info('API: answering again, resuming requests')
+            self.state = self.CLOSED
+            self.failures = 0
+            self.wait = self.delay
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.PROBING:
+                self.wait = min(self.wait * 2, self.max_delay)
+                self._open()
+            elif self.state == self.CLOSED and self.failures >= self.threshold:
+                self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.retry_at = time.monotonic() + self.wait
+        LOGGER.warning('API: {} failed requests in a row, pausing requests for {}s'.format(self.failures, self.wait))
+
+    def record(self, status_code):
+        if status_code >= 500:
+            self.failure()
+        else:
+            self.success()
+
+
+class TokenManager(object):
+    '''
+    Keeps the client credentials token fresh.  The token is renewed ahead
+    of expires_in, and the lock makes concurrent callers wait on a single
+    refresh instead of each starting their own.
+    '''
+    def __init__(self, fetch, margin=DEFAULT_TOKEN_MARGIN):
+        self.fetch = fetch
+        self.margin = margin
+        self.token = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
+
+    def valid(self):
+        return self.token is not None and time.monotonic() < self.expires_at
+
+    def get(self):
+        if not self.valid():
+            with self.lock:
+                if not self.valid():
+                    self._refresh()
+        return self.token
+
+    def refresh(self):
+        with self.lock:
+            return self._refresh()
+
+    def invalidate(self, token):
+        '''
+        Drop a token the API rejected, unless another caller has already
+        replaced it.
+        '''
+        with self.lock:
+            if self.token == token:
+                self.token = None
+
+    def _refresh(self):
+        token, expires_in = self.fetch()
+        if expires_in:
+            lifetime = max(expires_in - min(self.margin, expires_in / 2), 0)
+            self.expires_at = time.monotonic() + lifetime
+        else:
+            # Unknown lifetime, keep it until the API answers 401.
+            self.expires_at = float('inf')
+        self.token = token
+        return token
+
+
+class RateLimiter(object):
+    '''
+    Token bucket shared by every request a client sends, so discovery and
+    polling together stay under rate requests per second.  burst requests
+    may go out back to back after an idle period.  Requests come in two
+    priority classes: an interactive request takes the next free token
+    ahead of any background request still waiting for one.
+    '''
+    def __init__(self, rate=DEFAULT_RATE_LIMIT, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waiting = [0] * len(PRIORITY_NAMES)
+        self.cond = threading.Condition()
+
+    def set_rate(self, rate, burst=None):
+        with self.cond:
+            self.rate = float(rate)
+            self.burst = float(burst or max(1, rate))
+            self.tokens = min(self.tokens, self.burst)
+            self.cond.notify_all()
+
+    def _take(self, priority):
+        '''
+        Take a token if one is free and no higher priority request is
+        waiting.  Returns 0 on success, else how long to wait before
+        trying again.
+        '''
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if any(self.waiting[:priority]):
+            return 1.0 / self.rate
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        return 0
+
+    def try_acquire(self, priority=PRIORITY_BACKGROUND):
+        with self.cond:
+            return self._take(priority)
+
+    def acquire(self, priority=PRIORITY_BACKGROUND):
+        '''
+        Block until a token is ours, return the seconds spent waiting.
+        '''
+        start = time.monotonic()
+        with self.cond:
+            self.waiting[priority] += 1
+            try:
+                wait = self._take(priority)
+                while wait > 0:
+                    self.cond.wait(wait)
+                    wait = self._take(priority)
+            finally:
+                self.waiting[priority] -= 1
+                self.cond.notify_all()
+        return time.monotonic() - start
+
+
+def retry_after(resp):
+    '''
+    Seconds the server asked us to wait in Retry-After, None if absent.
+    '''
+    value = resp.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    if parsedate_to_datetime is None:
+        return None
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CachedResponse(object):
+    '''
+    A GET response kept by the ResponseCache: its validators and the
+    decoded body, so a 304 can be answered without parsing anything.
+    '''
+    def __init__(self, resp, body):
+        self.status_code = resp.status_code
+        self.body = body
+        self.etag = resp.headers.get('ETag')
+        self.last_modified = resp.headers.get('Last-Modified')
+        self.fetched_at = time.monotonic()
+        data = body.get('data') if isinstance(body, dict) else None
+        if isinstance(data, list):
+            data = data[0] if data else None
+        self.type_ = data.get('type') if isinstance(data, dict) else None
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache(object):
+    '''
+    LRU cache of GET responses keyed by URL and params.  An entry younger
+    than the TTL of its resource type is served without a request, an
+    older one is revalidated with If-None-Match / If-Modified-Since.
+    '''
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE, ttls={}):
+        self.max_entries = max_entries
+        self.ttls = dict(ttls)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(url, params):
+        return url, tuple(sorted((params or {}).items()))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def fresh(self, entry):
+        return time.monotonic() - entry.fetched_at < self.ttls.get(entry.type_, 0)
+
+    def put(self, key, entry):
+        if not self.ttls.get(entry.type_) and not entry.etag and not entry.last_modified:
+            # Nothing to revalidate with and no TTL, it would never be used.
+            return
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def touch(self, entry):
+        entry.fetched_at = time.monotonic()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
 class Relationship(object):
+    __slots__ = ('client', 'rel', 'self_href', 'related_href', 'data', 'resolved')
+
     def __init__(self, rel, client, rel_data):
         self.client = client
         self.rel = rel
         self.self_href = rel_data.get('links', {}).get('self', '')
         self.related_href = rel_data.get('links', {}).get('related', '')
         self.data = rel_data.get('data', {})
+        self.resolved = None
 
     def get(self, **params):
         return self.client.get_url(self.related_href, **params)
 
+    def resolve(self, included):
+        '''
+        Point this relationship at the resources a compound document
+        returned in its included array, if all of them are there.
+        '''
+        if isinstance(self.data, list):
+            found = [included.get((d.get('type'), d.get('id'))) for d in self.data]
+            if all(f is not None for f in found):
+                self.resolved = self.client.collection_class(
+                    self.client, {}, found[0].type_ if found else None, found
+                )
+        elif self.data:
+            self.resolved = included.get((self.data.get('type'), self.data.get('id')))
+
     def add(self, data):
         data = data if isinstance(data, list) else [data]
         rel_form = relationship_data(data)
@@ -82,7 +477,7 @@ class ResourceCollection(object):
     def load_next_page(self):
         if self.meta.get('next'):
             col = self.client.get_url(self.meta['next'])
-            self.resources = self.resources + col.resources
+            self.resources.extend(col.resources)
             self.meta = col.meta
 
     def __getitem__(self, idx):
@@ -96,114 +491,434 @@ class ResourceCollection(object):
             yield r
 
     def all(self):
-        idx = 0
-        while self.meta.get('next'):
-            if self[idx] == self.resources[-1]:
-                self.load_next_page()
-            yield self[idx]
-            idx = idx + 1
+        return self.stream()
+
+    def stream(self, limit=None, keep=True, prefetch=True):
+        '''
+        Yield every resource of every page, starting with the ones already
+        loaded, and stop after limit resources.  With prefetch the next
+        page is requested in the background while the caller works on the
+        current one.  With keep=False pages already handed out are dropped
+        and the collection only holds the last page fetched.
+        '''
+        page = list(self.resources)
+        count = 0
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='page') if prefetch else None
+        try:
+            while True:
+                following = None
+                more = limit is None or count + len(page) < limit
+                if more and executor is not None and self.meta.get('next'):
+                    following = executor.submit(self.client.get_url, self.meta['next'])
+
+                for resource in page:
+                    if limit is not None and count >= limit:
+                        return
+                    count += 1
+                    yield resource
+
+                if not more or not self.meta.get('next'):
+                    return
+                col = following.result() if following is not None else \
+                    self.client.get_url(self.meta['next'])
+                page = col.resources
+                if keep:
+                    self.resources.extend(page)
+                else:
+                    self.resources = page
+                self.meta = col.meta
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
 
     def up_to(self, limit):
-        while len(self.resources) < limit and self.meta.get('next'):
-            self.load_next_page()
+        for _ in self.stream(limit=limit):
+            pass
         return self
 
 
 class Resource(object):
+    '''
+    A JSON:API resource.  Relationship objects are only built when a
+    relationship is first used, most readings never touch theirs.
+    '''
+    __slots__ = ('client', 'id_', 'type_', 'attributes', 'deleted',
+                 '_rel_data', '_relationships', '__weakref__')
+    relationship_class = Relationship
+
     def __init__(self, client, id_, type_, attributes, relationships):
         self.client = client
         self.id_ = id_
         self.type_ = type_
         self.attributes = attributes
-        self.relationships = {rel: Relationship(rel, self.client, data)
-                              for rel, data in relationships.items()}
+        self._rel_data = relationships
+        self._relationships = {}
         self.deleted = False
 
+    @property
+    def relationships(self):
+        for rel in self._rel_data:
+            self.relationship(rel)
+        return self._relationships
+
+    @relationships.setter
+    def relationships(self, relationships):
+        self._rel_data = dict.fromkeys(relationships)
+        self._relationships = dict(relationships)
+
+    def relationship(self, rel):
+        r = self._relationships.get(rel)
+        if r is None:
+            r = self._relationships[rel] = self.relationship_class(rel, self.client, self._rel_data[rel])
+        return r
+
+    def has_relationship(self, rel):
+        return rel in self._rel_data
+
+    def take_relationships(self, other):
+        if other is self:
+            return
+        self._rel_data = other._rel_data
+        self._relationships = other._relationships
+
+    def merge(self, attributes, relationships):
+        '''
+        Take the attributes and relationships of a newer response for this
+        resource.  Relationships it only gives links for keep what an
+        earlier compound document resolved.  A response older than what
+        the resource holds, such as a cached body or a 304 answered from
+        one after a write landed, is ignored.  Returns whether it was
+        taken.
+        '''
+        before, after = updated_at(self.attributes or {}), updated_at(attributes or {})
+        if before is not None and after is not None and after < before:
+            return False
+        self.attributes = attributes
+        changed = [rel for rel, data in (relationships or {}).items()
+                   if rel not in self._rel_data or (data and 'data' in data)]
+        if changed:
+            # Copied, the dicts may belong to a cached response body.
+            rel_data = dict(self._rel_data)
+            for rel in changed:
+                rel_data[rel] = relationships[rel]
+                self._relationships.pop(rel, None)
+            self._rel_data = rel_data
+        return True
+
     def __eq__(self, other):
         return self.type_ == other.type_ and self.id_ == other.id_
 
     def to_relationship(self):
         return {"id": self.id_, "type": self.type_}
 
+    def to_dict(self):
+        '''
+        The resource in JSON:API form, relationships reduced to their
+        links, so Client.create_model(**r.to_dict()) rebuilds it.
+        '''
+        return {
+            'id': self.id_,
+            'type': self.type_,
+            'attributes': self.attributes,
+            'relationships': {
+                rel: {'links': {'self': r.self_href, 'related': r.related_href}}
+                for rel, r in self.relationships.items()
+            }
+        }
+
     def get_self(self):
         resp = self.client.get(self.type_, id=self.id_)
         self.attributes = resp.attributes
-        self.relationships = resp.relationships
+        self.take_relationships(resp)
         return self
 
     def get_rel(self, rel, **params):
-        return self.relationships[rel].get(**params)
+        return self.relationship(rel).get(**params)
+
+    def get_included(self, rel):
+        '''
+        The related resource(s) resolved from the last compound document,
+        or None if the response did not include them.
+        '''
+        return self.relationship(rel).resolved if self.has_relationship(rel) else None
 
     def update(self, attributes={}, relationships={}):
         resp = self.client.update(
             self.type_, self.id_, attributes, relationships
         )
         self.attributes = resp.attributes
-        self.relationships = resp.relationships
+        self.take_relationships(resp)
         return self
 
     def delete(self):
         self.client.delete(self.type_, self.id_)
+        self.client.forget(self)
         self.deleted = True
 
     def add_rel(self, **kwargs):
         for rel, val in kwargs.items():
-            self.relationships[rel].add(val)
+            self.relationship(rel).add(val)
 
     def update_rel(self, **kwargs):
         for rel, val in kwargs.items():
-            self.relationships[rel].update(val)
+            self.relationship(rel).update(val)
 
     def delete_rel(self, **kwargs):
         for rel, val in kwargs.items():
-            self.relationships[rel].delete(val)
+            self.relationship(rel).delete(val)
 
 
 class Client(object):
+    collection_class = ResourceCollection
+
     def __init__(self,
                  client_id=None,
                  client_secret=None,
                  api_root='https://api-qa.flair.co/',
                  mapper={},
                  admin=False,
-                 default_model=Resource):
+                 default_model=Resource,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 session=None,
+                 api_root_cache=None,
+                 api_root_ttl=DEFAULT_API_ROOT_TTL,
+                 response_cache=None,
+                 rate_limiter=None,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 json_loads=json_loads,
+                 metrics=None,
+                 breaker=None,
+                 timeout=DEFAULT_TIMEOUT):
         self.admin = admin
         self.client_id = client_id
         self.client_secret = client_secret
         self.api_root = api_root
         self.mapper = mapper
         self.default_model = default_model
+        self.token = None
+        self.expires_in = None
+        self.api_root_resp = None
+        self.api_root_cache = api_root_cache
+        self.api_root_ttl = api_root_ttl
+        self.api_root_cached = False
+        self.headers = dict(DEFAULT_CLIENT_HEADERS)
+        self.timeout = timeout
+        self.session = session or self.make_session(pool_size)
+        self.tokens = TokenManager(self.fetch_token)
+        self.response_cache = response_cache
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.breaker = breaker or CircuitBreaker()
+        self.max_retries = max_retries
+        self.json_loads = json_loads
+        self.metrics = metrics
+        self.counters = {'requests': 0, 'throttled': 0, 'retries': 0}
+        self.counters_lock = threading.Lock()
+        # Every live Resource by (type, id), see create_model().
+        self.models = weakref.WeakValueDictionary()
+        self.models_lock = threading.Lock()
+
+    def make_session(self, pool_size):
+        '''
+        One keep-alive session per client so every request to the API host
+        reuses an already open TLS connection from the pool.
+        '''
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def close(self):
+        self.session.close()
 
     def create_url(self, path):
         return urljoin(self.api_root, path)
 
-    def oauth_token(self):
-        resp = requests.post(self.create_url("/oauth/token"), data=dict(
+    def set_token(self, token):
+        self.token = token
+        # Swap in a complete header dict so in-flight requests on other
+        # threads keep the one they already picked up.
+        headers = dict(DEFAULT_CLIENT_HEADERS)
+        headers.update(self.token_header())
+        self.headers = headers
+
+    def count(self, counter):
+        '''
+        Count a request, throttled answer or retry, here and in the
+        metrics, where the longPoll summary reports them.
+        '''
+        with self.counters_lock:
+            self.counters[counter] += 1
+        if self.metrics is not None:
+            self.metrics.count(counter)
+
+    def send(self, method, url, **kwargs):
+        '''
+        Send one request through the circuit breaker and the rate
+        limiter, in the priority class of the calling thread.  429 and
+        503 answers are retried with exponential backoff and jitter, or
+        after the delay the server gave in Retry-After.  A request that
+        fails to connect or is not answered within the client's timeout
+        counts against the breaker.
+        '''
+        if not self.breaker.allow():
+            raise CircuitOpenError(self.breaker)
+        attempt = 0
+        priority = request_priority()
+        while True:
+            queued = self.rate_limiter.acquire(priority)
+            if self.metrics is not None:
+                self.metrics.record_queue(priority, queued)
+            self.count('requests')
+            try:
+                resp = self.timed_request(method, url, **kwargs)
+            except requests.RequestException:
+                self.breaker.failure()
+                raise
+            if resp.status_code not in RETRY_STATUS:
+                break
+            delay = self.retry_delay(resp, attempt, method, url)
+            if delay is None:
+                break
+            time.sleep(delay)
+            attempt += 1
+        self.breaker.record(resp.status_code)
+        return resp
+
+    def probe(self):
+        '''
+        Ask for the API root, True if the API answered.  Used to test
+        whether an open breaker can close.
+        '''
+        try:
+            return self.send('GET', self.create_url("/api/"), headers=DEFAULT_CLIENT_HEADERS).status_code < 500
+        except (requests.RequestException, ApiError):
+            return False
+
+    def retry_delay(self, resp, attempt, method, url):
+        '''
+        Seconds to wait before retrying a throttled request, None once
+        max_retries is used up.
+        '''
+        self.count('throttled')
+        if attempt >= self.max_retries:
+            LOGGER.warning('API: {} {} still throttled after {} retries'.format(method, url, attempt))
+            return None
+        delay = retry_after(resp)
+        if delay is None:
+            delay = random.uniform(0, RETRY_BASE_DELAY * 2 ** attempt)
+        delay = min(delay, RETRY_MAX_DELAY)
+        LOGGER.info('API: HTTP {} for {}, retrying in {:.1f}s'.format(resp.status_code, url, delay))
+        self.count('retries')
+        return delay
+
+    def timed_request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if self.metrics is None:
+            return self.session.request(method, url, **kwargs)
+        start = time.monotonic()
+        try:
+            resp = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self.metrics.record_request(method, url, None, time.monotonic() - start)
+            raise
+        self.metrics.record_request(method, url, resp.status_code, time.monotonic() - start, len(resp.content or b''))
+        return resp
+
+    def fetch_token(self):
+        resp = self.send('POST', self.create_url("/oauth/token"), data=dict(
             client_id=self.client_id,
             client_secret=self.client_secret,
             grant_type="client_credentials"
         ))
+        if resp.status_code >= 400:
+            raise ApiError(resp)
 
-        self.token = resp.json().get('access_token')
+        self.set_token(resp.json().get('access_token'))
         self.expires_in = resp.json().get('expires_in')
 
-        return resp.status_code
+        return self.token, self.expires_in
+
+    def oauth_token(self):
+        return self.tokens.refresh()
+
+    def _request(self, method, url, headers=None, **kwargs):
+        if method != 'GET' and self.response_cache is not None:
+            # Whatever was written may be in any cached document.
+            self.response_cache.clear()
+        token = self.tokens.get()
+        resp = self.send(method, url, headers=self.request_headers(headers), **kwargs)
+        if resp.status_code == 401:
+            LOGGER.debug('API: token rejected, renewing and retrying {}'.format(url))
+            self.tokens.invalidate(token)
+            self.tokens.get()
+            resp = self.send(method, url, headers=self.request_headers(headers), **kwargs)
+        return resp
+
+    def request_headers(self, extra):
+        if not extra:
+            return self.headers
+        headers = dict(self.headers)
+        headers.update(extra)
+        return headers
 
     def api_root_response(self):
-        resp = requests.get(
-            self.create_url("/api/"), headers=DEFAULT_CLIENT_HEADERS
+        resp = self.send(
+            'GET', self.create_url("/api/"), headers=DEFAULT_CLIENT_HEADERS
         )
         self.api_root_resp = resp.json().get('links')
+        self.api_root_cached = False
+        if resp.status_code == 200:
+            self.write_api_root_cache()
 
         return resp.status_code
 
-    def _fetch_token_if_not(self):
-        if self.token is None:
-            return self.oauth_token()
+    def load_api_root(self):
+        '''
+        Use the link map cached on disk when it is fresh and belongs to
+        this API root, otherwise fetch /api/ and cache it.
+        '''
+        links = self.read_api_root_cache()
+        if links is None:
+            return self.api_root_response()
+        LOGGER.debug('API: using cached API root from {}'.format(self.api_root_cache))
+        self.api_root_resp = links
+        self.api_root_cached = True
+
+    def read_api_root_cache(self):
+        if not self.api_root_cache:
+            return None
+        try:
+            with open(self.api_root_cache) as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        links = cached.get('links') if isinstance(cached, dict) else None
+        if cached.get('api_root') != self.api_root or \
+           time.time() - cached.get('fetched-at', 0) > self.api_root_ttl or \
+           not isinstance(links, dict) or \
+           not all(isinstance(l, dict) and 'self' in l for l in links.values()):
+            return None
+        return links
+
+    def write_api_root_cache(self):
+        if not self.api_root_cache or not isinstance(self.api_root_resp, dict):
+            return
+        tmp = self.api_root_cache + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'api_root': self.api_root,
+                           'fetched-at': time.time(),
+                           'links': self.api_root_resp}, f)
+            os.replace(tmp, self.api_root_cache)
+        except (IOError, OSError) as ex:
+            LOGGER.warning('API: could not write {}: {}'.format(self.api_root_cache, ex))
 
     def _fetch_api_root_if_not(self):
         if self.api_root_resp is None:
-            return self.api_root_response()
+            return self.load_api_root()
 
     def token_header(self):
         headers = {'Authorization': 'Bearer ' + self.token}
@@ -212,29 +927,24 @@ class Client(object):
         return headers
 
     def resource_url(self, resource_type, id):
+        if resource_type not in self.api_root_resp and self.api_root_cached:
+            LOGGER.debug('API: {} missing from cached API root, refetching'.format(resource_type))
+            self.api_root_response()
         resource_path = self.api_root_resp[resource_type]['self']
         if id:
             resource_path = resource_path + "/" + str(id)
 
         return resource_path
 
-    def get(self, resource_type, id=None):
-        self._fetch_token_if_not()
+    def get(self, resource_type, id=None, include=None):
         self._fetch_api_root_if_not()
-        LOGGER.debug('API: get request for {}'.format(self.resource_url(resource_type, id)))
-        return self.handle_resp(
-            requests.get(
-                self.create_url(self.resource_url(resource_type, id)),
-                headers=dict(self.token_header(), **DEFAULT_CLIENT_HEADERS)
-            )
-        )
+        return self.get_url(self.resource_url(resource_type, id), include=include)
 
     def to_relationship_dict(self, relationships):
         return {k: {'data': relationship_data(r)}
                 for k, r in relationships.items()}
 
     def update(self, resource_type, id, attributes, relationships):
-        self._fetch_token_if_not()
         self._fetch_api_root_if_not()
         rels = self.to_relationship_dict(relationships)
         req_body = {'data': {
@@ -245,23 +955,21 @@ class Client(object):
         }}
 
         return self.handle_resp(
-            requests.patch(
+            self._request(
+                'PATCH',
                 self.create_url(self.resource_url(resource_type, id)),
-                headers=dict(self.token_header(), **DEFAULT_CLIENT_HEADERS),
                 json=req_body
             )
         )
 
     def delete(self, resource_type, id):
-        self._fetch_token_if_not()
         self._fetch_api_root_if_not()
-        requests.delete(
-            self.create_url(self.resource_url(resource_type, id)),
-            headers=dict(self.token_header(), **DEFAULT_CLIENT_HEADERS)
+        self._request(
+            'DELETE',
+            self.create_url(self.resource_url(resource_type, id))
         )
 
     def create(self, resource_type, attributes={}, relationships={}, params={}):
-        self._fetch_token_if_not()
         self._fetch_api_root_if_not()
         rels = self.to_relationship_dict(relationships)
         req_body = {'data': {
@@ -271,73 +979,143 @@ class Client(object):
         }}
 
         return self.handle_resp(
-            requests.post(
+            self._request(
+                'POST',
                 self.create_url(self.resource_url(resource_type, None)),
-                headers=dict(self.token_header(), **DEFAULT_CLIENT_HEADERS),
                 json=req_body,
                 params=params
             )
         )
 
     def delete_url(self, url, data):
-        return self.handle_resp(requests.delete(
+        return self.handle_resp(self._request(
+            'DELETE',
             self.create_url(url),
-            headers=dict(self.token_header(), **DEFAULT_CLIENT_HEADERS),
             json=data
         ))
 
     def patch_url(self, url, data):
-        return self.handle_resp(requests.patch(
+        return self.handle_resp(self._request(
+            'PATCH',
             self.create_url(url),
-            headers=dict(self.token_header(), **DEFAULT_CLIENT_HEADERS),
             json=data
         ))
 
     def post_url(self, url, data):
-        return self.handle_resp(requests.post(
+        return self.handle_resp(self._request(
+            'POST',
             self.create_url(url),
-            headers=dict(self.token_header(), **DEFAULT_CLIENT_HEADERS),
             json=data
         ))
 
-    def get_url(self, url, **params):
-        LOGGER.debug('API: get request for {}'.format(self.create_url(url)))
-        return self.handle_resp(requests.get(
-            self.create_url(url),
-            params=params,
-            headers=dict(self.token_header(), **DEFAULT_CLIENT_HEADERS)
-        ))
+    def get_url(self, url, include=None, **params):
+        if include:
+            params['include'] = include
+        url = self.create_url(url)
+        if self.response_cache is None:
+            LOGGER.debug('API: get request for {}'.format(url))
+            return self.handle_resp(self._request('GET', url, params=params))
+        return self.cached_get(url, params)
+
+    def cached_get(self, url, params):
+        key = self.response_cache.key(url, params)
+        entry = self.response_cache.get(key)
+        if entry is not None and self.response_cache.fresh(entry):
+            LOGGER.debug('API: cached response for {}'.format(url))
+            return self.handle_body(entry, entry.body)
+
+        LOGGER.debug('API: get request for {}'.format(url))
+        resp = self._request('GET', url, params=params,
+                             headers=entry.conditional_headers() if entry else None)
+        if resp.status_code == 304 and entry is not None:
+            LOGGER.debug('API: not modified {}'.format(url))
+            self.response_cache.touch(entry)
+            return self.handle_body(entry, entry.body)
+
+        body = self.decode_body(resp)
+        if resp.status_code == 200:
+            self.response_cache.put(key, CachedResponse(resp, body))
+        return self.handle_body(resp, body)
 
     def create_model(self,
                      id=None,
                      type=None,
                      attributes={},
                      relationships={}):
+        '''
+        The one Resource for (type, id).  If one is still held anywhere it
+        takes the new attributes unless they are older than its own, see
+        Resource.merge(), and is returned, so a resource read from several
+        responses is a single object with the latest data.
+        '''
         klass = self.mapper.get(type, self.default_model)
-        return klass(self, id, type, attributes, relationships)
+        if id is None:
+            return klass(self, id, type, attributes, relationships)
+        with self.models_lock:
+            model = self.models.get((type, id))
+            if model is None:
+                model = klass(self, id, type, attributes, relationships)
+                self.models[(type, id)] = model
+                return model
+        model.merge(attributes, relationships)
+        return model
+
+    def forget(self, resource):
+        with self.models_lock:
+            if self.models.get((resource.type_, resource.id_)) is resource:
+                del self.models[(resource.type_, resource.id_)]
+
+    def resolve_included(self, resources, included):
+        index = {}
+        for r in included:
+            model = self.create_model(
+                id=r.get('id'),
+                type=r.get('type'),
+                attributes=r.get('attributes', {}),
+                relationships=r.get('relationships', {})
+            )
+            index[(model.type_, model.id_)] = model
 
-    def handle_resp(self, resp):
+        for resource in resources + list(index.values()):
+            # Links-only relationships have nothing to resolve, leave
+            # them unbuilt.
+            for rel, data in resource._rel_data.items():
+                if data and 'data' in data:
+                    resource.relationship(rel).resolve(index)
+
+    def decode_body(self, resp):
         if not resp.status_code == 204 and resp.status_code < 400:
-            body = resp.json()
-        else:
-            body = ''
+            return self.json_loads(resp.content)
+        return ''
+
+    def handle_resp(self, resp):
+        return self.handle_body(resp, self.decode_body(resp))
 
+    def handle_body(self, resp, body):
         if resp.status_code == 200 and isinstance(body['data'], list) and \
            body['data']:
-               LOGGER.debug('GOT: {}'.format(body['data']))
+               if LOGGER.isEnabledFor(logging.DEBUG):
+                   LOGGER.debug('GOT: {}'.format(body['data']))
 
-               return ResourceCollection(
+               resources = [self.create_model(**r) for r in body['data']]
+               if body.get('included'):
+                   self.resolve_included(resources, body['included'])
+               return self.collection_class(
                        self,
                        body['meta'],
                        body['data'][0]['type'],
-                       [self.create_model(**r) for r in body['data']]
+                       resources
                        )
         elif (resp.status_code == 200 or resp.status_code == 201) and \
              not body['data']:
             raise EmptyBodyException(resp)
         elif resp.status_code == 200 or resp.status_code == 201:
-            LOGGER.debug('Calling create_model with {}'.format(body['data']))
-            return self.create_model(**body['data'])
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug('Calling create_model with {}'.format(body['data']))
+            resource = self.create_model(**body['data'])
+            if body.get('included'):
+                self.resolve_included([resource], body['included'])
+            return resource
         elif resp.status_code >= 400:
             raise ApiError(resp)
         else:
@@ -345,14 +1123,20 @@ class Client(object):
             return body
 
 
-def make_client(client_id, client_secret, root, mapper={}, admin=False):
+def make_client(client_id, client_secret, root, mapper={}, admin=False,
+                pool_size=DEFAULT_POOL_SIZE, api_root_cache=None,
+                response_cache=None, rate_limiter=None):
     c = Client(
        client_id=client_id,
        client_secret=client_secret,
        api_root=root,
        mapper=mapper,
-       admin=admin
+       admin=admin,
+       pool_size=pool_size,
+       api_root_cache=api_root_cache,
+       response_cache=response_cache,
+       rate_limiter=rate_limiter
     )
     c.oauth_token()
-    c.api_root_response()
+    c.load_api_root()
     return c
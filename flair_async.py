@@ -0,0 +1,430 @@
+import asyncio
+import threading
+import time
+import udi_interface
+from flair_api import Client
+from flair_api import Relationship
+from flair_api import Resource
+from flair_api import ResourceCollection
+from flair_api import TokenManager
+from flair_api import CachedResponse
+from flair_api import ApiError
+from flair_api import CircuitOpenError
+from flair_api import DEFAULT_CLIENT_HEADERS
+from flair_api import DEFAULT_POOL_SIZE
+from flair_api import RETRY_STATUS
+from flair_api import PRIORITY_BACKGROUND
+from flair_api import relationship_data
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import h2
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+LOGGER = udi_interface.LOGGER
+
+DEFAULT_IN_FLIGHT = 8
+
+
+class AsyncTokenManager(TokenManager):
+    '''
+    TokenManager for the event loop, concurrent tasks wait on a single
+    refresh.
+    '''
+    def __init__(self, fetch, **kwargs):
+        super(AsyncTokenManager, self).__init__(fetch, **kwargs)
+        self.lock = None
+
+    def _lock(self):
+        # Created on first use so it belongs to the client's loop.
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        return self.lock
+
+    async def get(self):
+        if not self.valid():
+            async with self._lock():
+                if not self.valid():
+                    await self._refresh()
+        return self.token
+
+    async def refresh(self):
+        async with self._lock():
+            return await self._refresh()
+
+    def invalidate(self, token):
+        if self.token == token:
+            self.token = None
+
+    async def _refresh(self):
+        token, expires_in = await self.fetch()
+        if expires_in:
+            lifetime = max(expires_in - min(self.margin, expires_in / 2), 0)
+            self.expires_at = time.monotonic() + lifetime
+        else:
+            self.expires_at = float('inf')
+        self.token = token
+        return token
+
+
+class AsyncRelationship(Relationship):
+    __slots__ = ()
+
+    async def get(self, **params):
+        return await self.client.get_url(self.related_href, **params)
+
+    async def add(self, data):
+        data = data if isinstance(data, list) else [data]
+        rel_form = relationship_data(data)
+        self.data.append(rel_form)
+        await self.client.post_url(self.self_href, dict(data=rel_form))
+
+    async def update(self, data):
+        rel_form = relationship_data(data)
+        self.data = rel_form
+        await self.client.patch_url(self.self_href, dict(data=rel_form))
+        return self.data
+
+    async def delete(self, data):
+        data = data if isinstance(data, list) else [data]
+        rel_form = relationship_data(data)
+        self.data.remove(rel_form)
+        await self.client.delete_url(self.self_href, dict(data=rel_form))
+
+
+class AsyncResourceCollection(ResourceCollection):
+    async def load_next_page(self):
+        if self.meta.get('next'):
+            col = await self.client.get_url(self.meta['next'])
+            self.resources.extend(col.resources)
+            self.meta = col.meta
+
+    def all(self):
+        return self.stream()
+
+    async def stream(self, limit=None, keep=True, prefetch=True):
+        '''
+        Async version of ResourceCollection.stream(), the next page is
+        fetched as a task while the caller works on the current one.
+        '''
+        page = list(self.resources)
+        count = 0
+        following = None
+        try:
+            while True:
+                more = limit is None or count + len(page) < limit
+                if more and prefetch and self.meta.get('next'):
+                    following = asyncio.ensure_future(self.client.get_url(self.meta['next']))
+
+                for resource in page:
+                    if limit is not None and count >= limit:
+                        return
+                    count += 1
+                    yield resource
+
+                if not more or not self.meta.get('next'):
+                    return
+                if following is not None:
+                    col, following = await following, None
+                else:
+                    col = await self.client.get_url(self.meta['next'])
+                page = col.resources
+                if keep:
+                    self.resources.extend(page)
+                else:
+                    self.resources = page
+                self.meta = col.meta
+        finally:
+            if following is not None:
+                following.cancel()
+
+    async def up_to(self, limit):
+        async for _ in self.stream(limit=limit):
+            pass
+        return self
+
+
+class AsyncResource(Resource):
+    __slots__ = ()
+    relationship_class = AsyncRelationship
+
+    async def get_self(self):
+        resp = await self.client.get(self.type_, id=self.id_)
+        self.attributes = resp.attributes
+        self.take_relationships(resp)
+        return self
+
+    async def get_rel(self, rel, **params):
+        return await self.relationship(rel).get(**params)
+
+    async def update(self, attributes={}, relationships={}):
+        resp = await self.client.update(
+            self.type_, self.id_, attributes, relationships
+        )
+        self.attributes = resp.attributes
+        self.take_relationships(resp)
+        return self
+
+    async def delete(self):
+        await self.client.delete(self.type_, self.id_)
+        self.client.forget(self)
+        self.deleted = True
+
+    async def add_rel(self, **kwargs):
+        for rel, val in kwargs.items():
+            await self.relationship(rel).add(val)
+
+    async def update_rel(self, **kwargs):
+        for rel, val in kwargs.items():
+            await self.relationship(rel).update(val)
+
+    async def delete_rel(self, **kwargs):
+        for rel, val in kwargs.items():
+            await self.relationship(rel).delete(val)
+
+
+class AsyncClient(Client):
+    '''
+    Client for asyncio code, with the same models as the blocking Client
+    but coroutines for everything that touches the network.  Requests go
+    over one httpx connection pool, multiplexed on HTTP/2 when the h2
+    package is installed, with at most in_flight of them outstanding.
+    '''
+    collection_class = AsyncResourceCollection
+
+    def __init__(self, in_flight=DEFAULT_IN_FLIGHT, default_model=AsyncResource,
+                 pool_size=DEFAULT_POOL_SIZE, **kwargs):
+        if httpx is None:
+            raise ImportError('AsyncClient requires the httpx package')
+        super(AsyncClient, self).__init__(default_model=default_model, pool_size=pool_size, **kwargs)
+        self.tokens = AsyncTokenManager(self.fetch_token)
+        self.in_flight = in_flight
+        self.semaphore = None
+
+    def make_session(self, pool_size):
+        connect, read = self.timeout
+        return httpx.AsyncClient(http2=HTTP2, timeout=httpx.Timeout(read, connect=connect), limits=httpx.Limits(
+            max_connections=pool_size, max_keepalive_connections=pool_size))
+
+    async def close(self):
+        await self.session.aclose()
+
+    def _semaphore(self):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.in_flight)
+        return self.semaphore
+
+    async def send(self, method, url, **kwargs):
+        if not self.breaker.allow():
+            raise CircuitOpenError(self.breaker)
+        # The event loop only polls, so its requests are background ones
+        # and give way to commands.
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            wait = self.rate_limiter.try_acquire(PRIORITY_BACKGROUND)
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self.rate_limiter.try_acquire(PRIORITY_BACKGROUND)
+            if self.metrics is not None:
+                self.metrics.record_queue(PRIORITY_BACKGROUND, time.monotonic() - start)
+            self.count('requests')
+            try:
+                async with self._semaphore():
+                    resp = await self.timed_request(method, url, **kwargs)
+            except httpx.HTTPError:
+                self.breaker.failure()
+                raise
+            if resp.status_code not in RETRY_STATUS:
+                break
+            delay = self.retry_delay(resp, attempt, method, url)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+            attempt += 1
+        self.breaker.record(resp.status_code)
+        return resp
+
+    async def probe(self):
+        try:
+            resp = await self.send('GET', self.create_url("/api/"), headers=DEFAULT_CLIENT_HEADERS)
+            return resp.status_code < 500
+        except (httpx.HTTPError, ApiError):
+            return False
+
+    async def timed_request(self, method, url, **kwargs):
+        if self.metrics is None:
+            return await self.session.request(method, url, **kwargs)
+        start = time.monotonic()
+        try:
+            resp = await self.session.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.metrics.record_request(method, url, None, time.monotonic() - start)
+            raise
+        self.metrics.record_request(method, url, resp.status_code, time.monotonic() - start, len(resp.content or b''))
+        return resp
+
+    async def fetch_token(self):
+        resp = await self.send('POST', self.create_url("/oauth/token"), data=dict(
+            client_id=self.client_id,
+            client_secret=self.client_secret,
+            grant_type="client_credentials"
+        ))
+        if resp.status_code >= 400:
+            raise ApiError(resp)
+
+        self.set_token(resp.json().get('access_token'))
+        self.expires_in = resp.json().get('expires_in')
+
+        return self.token, self.expires_in
+
+    async def oauth_token(self):
+        return await self.tokens.refresh()
+
+    async def _request(self, method, url, headers=None, params=None, **kwargs):
+        if method != 'GET' and self.response_cache is not None:
+            self.response_cache.clear()
+        if params:
+            # httpx replaces the query of the URL with params, requests
+            # adds to it.  Merge here so paging links keep theirs.
+            url = str(httpx.URL(url).copy_merge_params(params))
+        token = await self.tokens.get()
+        resp = await self.send(method, url, headers=self.request_headers(headers), **kwargs)
+        if resp.status_code == 401:
+            LOGGER.debug('API: token rejected, renewing and retrying {}'.format(url))
+            self.tokens.invalidate(token)
+            await self.tokens.get()
+            resp = await self.send(method, url, headers=self.request_headers(headers), **kwargs)
+        return resp
+
+    async def api_root_response(self):
+        resp = await self.send(
+            'GET', self.create_url("/api/"), headers=DEFAULT_CLIENT_HEADERS
+        )
+        self.api_root_resp = resp.json().get('links')
+        self.api_root_cached = False
+        if resp.status_code == 200:
+            self.write_api_root_cache()
+
+        return resp.status_code
+
+    async def load_api_root(self):
+        links = self.read_api_root_cache()
+        if links is None:
+            return await self.api_root_response()
+        LOGGER.debug('API: using cached API root from {}'.format(self.api_root_cache))
+        self.api_root_resp = links
+        self.api_root_cached = True
+
+    async def _fetch_api_root_if_not(self):
+        if self.api_root_resp is None:
+            return await self.load_api_root()
+
+    async def resource_url(self, resource_type, id):
+        if resource_type not in self.api_root_resp and self.api_root_cached:
+            LOGGER.debug('API: {} missing from cached API root, refetching'.format(resource_type))
+            await self.api_root_response()
+        resource_path = self.api_root_resp[resource_type]['self']
+        if id:
+            resource_path = resource_path + "/" + str(id)
+
+        return resource_path
+
+    async def get(self, resource_type, id=None, include=None):
+        await self._fetch_api_root_if_not()
+        return await self.get_url(await self.resource_url(resource_type, id), include=include)
+
+    async def update(self, resource_type, id, attributes, relationships):
+        await self._fetch_api_root_if_not()
+        req_body = {'data': {
+            'id': id,
+            'type': resource_type,
+            'attributes': attributes,
+            'relationships': self.to_relationship_dict(relationships)
+        }}
+        url = self.create_url(await self.resource_url(resource_type, id))
+        return self.handle_resp(await self._request('PATCH', url, json=req_body))
+
+    async def delete(self, resource_type, id):
+        await self._fetch_api_root_if_not()
+        await self._request('DELETE', self.create_url(await self.resource_url(resource_type, id)))
+
+    async def create(self, resource_type, attributes={}, relationships={}, params={}):
+        await self._fetch_api_root_if_not()
+        req_body = {'data': {
+            'type': resource_type,
+            'attributes': attributes,
+            'relationships': self.to_relationship_dict(relationships)
+        }}
+        url = self.create_url(await self.resource_url(resource_type, None))
+        return self.handle_resp(await self._request('POST', url, json=req_body, params=params))
+
+    async def delete_url(self, url, data):
+        return self.handle_resp(await self._request('DELETE', self.create_url(url), json=data))
+
+    async def patch_url(self, url, data):
+        return self.handle_resp(await self._request('PATCH', self.create_url(url), json=data))
+
+    async def post_url(self, url, data):
+        return self.handle_resp(await self._request('POST', self.create_url(url), json=data))
+
+    async def get_url(self, url, include=None, **params):
+        if include:
+            params['include'] = include
+        url = self.create_url(url)
+        if self.response_cache is None:
+            LOGGER.debug('API: get request for {}'.format(url))
+            return self.handle_resp(await self._request('GET', url, params=params))
+        return await self.cached_get(url, params)
+
+    async def cached_get(self, url, params):
+        key = self.response_cache.key(url, params)
+        entry = self.response_cache.get(key)
+        if entry is not None and self.response_cache.fresh(entry):
+            LOGGER.debug('API: cached response for {}'.format(url))
+            return self.handle_body(entry, entry.body)
+
+        LOGGER.debug('API: get request for {}'.format(url))
+        resp = await self._request('GET', url, params=params,
+                                   headers=entry.conditional_headers() if entry else None)
+        if resp.status_code == 304 and entry is not None:
+            self.response_cache.touch(entry)
+            return self.handle_body(entry, entry.body)
+
+        body = self.decode_body(resp)
+        if resp.status_code == 200:
+            self.response_cache.put(key, CachedResponse(resp, body))
+        return self.handle_body(resp, body)
+
+
+class EventLoopThread(object):
+    '''
+    An event loop on its own thread, so blocking node server code can run
+    coroutines on it and wait for the result.
+    '''
+    def __init__(self, name='asyncio'):
+        self.name = name
+        self.loop = None
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name=self.name, daemon=True)
+        self.thread.start()
+
+    def run(self, coro, timeout=None):
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread = None
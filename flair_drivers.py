@@ -0,0 +1,81 @@
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Most driver changes sent in one status message.
+MAX_BATCH = 500
+
+_current = contextvars.ContextVar('driver_batch', default=None)
+
+
+def current_batch():
+    '''
+    The DriverBatch of the running node update, None outside of one.
+    '''
+    return _current.get()
+
+
+@contextmanager
+def batching(batch):
+    '''
+    Stage the driver changes nodes make inside the block in batch, for
+    the current thread or asyncio task.  With None they go out one by
+    one as before.
+    '''
+    token = _current.set(batch)
+    try:
+        yield batch
+    finally:
+        _current.reset(token)
+
+
+class DriverBatch(object):
+    '''
+    Driver changes staged by node updates and sent to Polyglot together
+    by flush(), as one status message instead of one per driver.  A node
+    whose update fails partway drops what it staged with discard(), so
+    the ISY never sees half of a reading.  A value staged before a
+    command to the same driver was acknowledged, or while one is being
+    written, is dropped at flush() so it can't undo the command.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.staged = OrderedDict()
+
+    def stage(self, node, driver, value, force=False, uom=None, text=None):
+        with self.lock:
+            key = (node.address, driver)
+            previous = self.staged.get(key)
+            # Staged twice in a cycle the last value wins.
+            force = force or (previous is not None and previous[3])
+            self.staged[key] = (node, driver, value, force, uom, text, time.monotonic())
+
+    def discard(self, node):
+        with self.lock:
+            for key in [key for key in self.staged if key[0] == node.address]:
+                del self.staged[key]
+
+    def flush(self):
+        '''
+        Apply the staged values to their nodes and report the ones that
+        changed.  Returns how many were reported.
+        '''
+        with self.lock:
+            staged, self.staged = list(self.staged.values()), OrderedDict()
+        entries = []
+        poly = None
+        for node, driver, value, force, uom, text, staged_at in staged:
+            if driver in getattr(node, 'writing', ()) or \
+               getattr(node, 'acknowledged', {}).get(driver, 0) > staged_at:
+                continue
+            before = node.driverStatus(driver)
+            node.setDriver(driver, value, report=False, uom=uom, text=text)
+            status = node.driverStatus(driver)
+            if status is not None and (force or status != before):
+                entries.append(status)
+                poly = node.poly
+        for start in range(0, len(entries), MAX_BATCH):
+            poly.send({'set': entries[start:start + MAX_BATCH]}, 'status')
+        return len(entries)
@@ -0,0 +1,180 @@
+import math
+import mmap
+import os
+import struct
+import threading
+import udi_interface
+from collections import namedtuple
+
+LOGGER = udi_interface.LOGGER
+
+# Numeric reading fields kept per device, in row order after the time.
+FIELDS = ('temperature', 'humidity', 'pressure', 'percent-open', 'voltage', 'rssi')
+DEFAULT_HISTORY_SIZE = 1024
+DEFAULT_SLOTS = 32
+
+MAGIC = b'FLHS'
+VERSION = 1
+# magic, version, samples per device, devices
+HEADER = struct.Struct('<4sIII')
+# node address, next row, rows used
+SLOT = struct.Struct('<16sII')
+ROW = 1 + len(FIELDS)
+DOUBLE = 8
+
+Aggregate = namedtuple('Aggregate', ('count', 'min', 'max', 'mean', 'slope'))
+
+
+def aggregate(samples):
+    '''
+    Count, min, max, mean and least squares slope per second of a list
+    of (time, value) samples, None if there are none.
+    '''
+    if not samples:
+        return None
+    n = len(samples)
+    t0 = samples[0][0]
+    st = sv = stt = stv = 0.0
+    low = high = samples[0][1]
+    for t, v in samples:
+        t -= t0
+        st += t
+        sv += v
+        stt += t * t
+        stv += t * v
+        low = min(low, v)
+        high = max(high, v)
+    spread = n * stt - st * st
+    slope = (n * stv - st * sv) / spread if spread > 0 else 0.0
+    return Aggregate(n, low, high, sv / n, slope)
+
+
+class History(object):
+    '''
+    Recent readings of every device in one memory-mapped file.  Each
+    device gets a slot with a ring buffer of capacity rows of doubles,
+    the reading's time followed by FIELDS, NaN where a reading has no
+    value.  The file survives restarts; a file written with another
+    capacity is started over.
+    '''
+    def __init__(self, path, capacity=DEFAULT_HISTORY_SIZE):
+        self.path = path
+        self.capacity = capacity
+        self.block = SLOT.size + capacity * ROW * DOUBLE
+        self.lock = threading.Lock()
+        self.file = None
+        self.map = None
+        self.rows = None
+        self.slots = {}
+        self.open()
+
+    def open(self):
+        exists = os.path.exists(self.path)
+        self.file = open(self.path, 'r+b' if exists else 'w+b')
+        header = self.file.read(HEADER.size)
+        count = 0
+        if len(header) == HEADER.size:
+            magic, version, capacity, count = HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION or capacity != self.capacity:
+                LOGGER.info('History: {} has another layout, starting over'.format(self.path))
+                count = 0
+        self.resize(count or DEFAULT_SLOTS, keep=count)
+        for slot in range(count):
+            key, _, _ = SLOT.unpack_from(self.map, self.offset(slot))
+            key = key.rstrip(b'\0').decode('ascii')
+            if key:
+                self.slots[key] = slot
+
+    def resize(self, count, keep=0):
+        '''
+        Map the file with room for count slots, the first keep of them
+        holding data already.
+        '''
+        if self.map is not None:
+            self.rows.release()
+            self.map.close()
+        size = HEADER.size + count * self.block
+        if keep == 0:
+            self.file.truncate(0)
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.capacity, count)
+        self.rows = memoryview(self.map).cast('d')
+        self.count = count
+
+    def offset(self, slot):
+        return HEADER.size + slot * self.block
+
+    def slot(self, key):
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = len(self.slots)
+            if slot >= self.count:
+                self.resize(self.count * 2, keep=self.count)
+            SLOT.pack_into(self.map, self.offset(slot), key.encode('ascii')[:SLOT.size - 8], 0, 0)
+            self.slots[key] = slot
+        return slot
+
+    def row(self, slot, index):
+        '''
+        Index in self.rows of row index of slot.
+        '''
+        return (self.offset(slot) + SLOT.size) // DOUBLE + index * ROW
+
+    def record(self, key, timestamp, values):
+        '''
+        Add a reading taken at timestamp.  A reading already recorded,
+        the same one fetched again, is skipped.  Returns whether it was
+        added.
+        '''
+        with self.lock:
+            slot = self.slot(key)
+            key_, head, used = SLOT.unpack_from(self.map, self.offset(slot))
+            if used and self.rows[self.row(slot, (head - 1) % self.capacity)] >= timestamp:
+                return False
+            start = self.row(slot, head)
+            self.rows[start] = timestamp
+            for i, field in enumerate(FIELDS):
+                value = values.get(field)
+                self.rows[start + 1 + i] = float(value) if value is not None else float('nan')
+            SLOT.pack_into(self.map, self.offset(slot), key_, (head + 1) % self.capacity,
+                           min(used + 1, self.capacity))
+            return True
+
+    def samples(self, key, field, window=None):
+        '''
+        (time, value) of field in time order, within window seconds of
+        the latest reading if a window is given.
+        '''
+        column = 1 + FIELDS.index(field)
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None:
+                return []
+            _, head, used = SLOT.unpack_from(self.map, self.offset(slot))
+            rows = [self.row(slot, (head - used + i) % self.capacity) for i in range(used)]
+            samples = [(self.rows[r], self.rows[r + column]) for r in rows]
+        samples = [s for s in samples if not math.isnan(s[1])]
+        if window is not None and samples:
+            since = samples[-1][0] - window
+            samples = [s for s in samples if s[0] >= since]
+        return samples
+
+    def aggregate(self, key, field, window=None):
+        return aggregate(self.samples(key, field, window))
+
+    def flush(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.flush()
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.flush()
+                self.rows.release()
+                self.map.close()
+                self.map = None
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,158 @@
+import re
+import threading
+import udi_interface
+from flair_api import PRIORITY_NAMES
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+LOGGER = udi_interface.LOGGER
+
+# Upper bounds of the request latency buckets in milliseconds.
+LATENCY_BUCKETS = (25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+ID_SEGMENT = re.compile(r'^(\d+|[0-9a-f]{8}-[0-9a-f-]{27})$', re.I)
+
+
+def endpoint(method, url):
+    '''
+    Group requests by method and path with the resource ids taken out,
+    e.g. GET /api/rooms/:id/vents.
+    '''
+    path = '/'.join(':id' if ID_SEGMENT.match(s) else s for s in urlparse(url).path.split('/'))
+    return method + ' ' + path
+
+
+class RequestStats(object):
+    __slots__ = ('count', 'errors', 'status', 'total_ms', 'max_ms', 'buckets', 'bytes')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.status = {}
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.bytes = 0
+
+    def add(self, status, ms, nbytes):
+        self.count += 1
+        self.status[status] = self.status.get(status, 0) + 1
+        if status is None or status >= 400:
+            self.errors += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                break
+        self.bytes += nbytes
+
+    def percentile(self, p):
+        '''
+        Upper bound of the bucket holding the p-th percentile.
+        '''
+        target = self.count * p / 100.0
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.buckets):
+            seen += n
+            if n and seen >= target:
+                return bound
+        return 0
+
+
+class Metrics(object):
+    '''
+    Counters for API requests, node updates and poll cycles.  Recording
+    is a dict lookup and a few additions under one lock, cheap enough to
+    leave on.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.request_count = 0
+        self.error_count = 0
+        self.nodes = {}
+        self.queues = {}
+        self.cycles = 0
+        self.skipped = 0
+        # API client events by name: requests, throttled, retries.
+        self.counters = {}
+        self.last_cycle = {'ms': 0, 'requests': 0, 'errors': 0, 'nodes': 0}
+
+    def record_request(self, method, url, status, seconds, nbytes=0):
+        key = endpoint(method, url)
+        with self.lock:
+            stats = self.requests.get(key)
+            if stats is None:
+                stats = self.requests[key] = RequestStats()
+            stats.add(status, seconds * 1000, nbytes)
+            self.request_count += 1
+            if status is None or status >= 400:
+                self.error_count += 1
+
+    def record_queue(self, priority, seconds):
+        '''
+        Time a request waited for the rate limiter, by priority class.
+        '''
+        with self.lock:
+            count, total, longest = self.queues.get(priority, (0, 0.0, 0.0))
+            self.queues[priority] = (count + 1, total + seconds, max(longest, seconds))
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + 1
+
+    def record_node(self, address, seconds):
+        with self.lock:
+            count, total, longest = self.nodes.get(address, (0, 0.0, 0.0))
+            self.nodes[address] = (count + 1, total + seconds, max(longest, seconds))
+
+    def cycle(self):
+        '''
+        Mark the start of a poll cycle, pass the result to end_cycle().
+        '''
+        with self.lock:
+            return self.request_count, self.error_count
+
+    def end_cycle(self, start, seconds, nodes):
+        with self.lock:
+            self.cycles += 1
+            self.last_cycle = {'ms': int(seconds * 1000),
+                               'requests': self.request_count - start[0],
+                               'errors': self.error_count - start[1],
+                               'nodes': nodes}
+            return dict(self.last_cycle)
+
+    def skip_cycle(self):
+        with self.lock:
+            self.skipped += 1
+
+    def error_rate(self):
+        '''
+        Percentage of the last cycle's requests that failed.
+        '''
+        cycle = self.last_cycle
+        return round(100.0 * cycle['errors'] / cycle['requests'], 1) if cycle['requests'] else 0
+
+    def log_summary(self):
+        with self.lock:
+            LOGGER.info('Metrics: {} cycles, {} skipped, last {} ms with {} requests and {} errors'.format(
+                self.cycles, self.skipped, self.last_cycle['ms'],
+                self.last_cycle['requests'], self.last_cycle['errors']))
+            LOGGER.info('Metrics: {} requests sent, {} throttled, {} retried'.format(
+                self.counters.get('requests', 0), self.counters.get('throttled', 0),
+                self.counters.get('retries', 0)))
+            for key, stats in sorted(self.requests.items()):
+                LOGGER.info('Metrics: {} n={} errors={} avg={:.0f}ms p50<={}ms p95<={}ms max={:.0f}ms bytes={} status={}'.format(
+                    key, stats.count, stats.errors, stats.total_ms / stats.count,
+                    stats.percentile(50), stats.percentile(95), stats.max_ms,
+                    stats.bytes, stats.status))
+            for priority, (count, total, longest) in sorted(self.queues.items()):
+                LOGGER.info('Metrics: {} queue n={} avg={:.0f}ms max={:.0f}ms'.format(
+                    PRIORITY_NAMES[priority], count, total * 1000 / count, longest * 1000))
+            slowest = sorted(self.nodes.items(), key=lambda n: n[1][2], reverse=True)[:5]
+            for address, (count, total, longest) in slowest:
+                LOGGER.info('Metrics: node {} n={} avg={:.0f}ms max={:.0f}ms'.format(
+                    address, count, total * 1000 / count, longest * 1000))
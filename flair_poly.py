@@ -7,18 +7,137 @@ Using the Flair API Client - https://github.com/flair-systems/flair-api-client-p
 """
 
 import udi_interface
+import asyncio
 import hashlib
 import time
 import json
+import os
 import sys
+from collections import OrderedDict
 from copy import deepcopy
-from threading import Thread
-from flair_api import make_client
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+from flair_api import DEFAULT_POOL_SIZE
 from flair_api import ApiError
 from flair_api import EmptyBodyException
+from flair_api import DEFAULT_RATE_LIMIT
+from flair_api import DEFAULT_BREAKER_THRESHOLD
+from flair_api import DEFAULT_CONNECT_TIMEOUT
+from flair_api import DEFAULT_READ_TIMEOUT
+from flair_api import parse_timestamp
+from flair_scheduler import PollScheduler
+from flair_scheduler import DEFAULT_INTERVALS
+from flair_metrics import Metrics
+from flair_async import EventLoopThread
+from flair_accounts import Account
+from flair_accounts import parse_accounts
+from flair_writes import WriteCoalescer
+from flair_writes import DEFAULT_WRITE_DELAY
+from flair_history import History
+from flair_history import DEFAULT_HISTORY_SIZE
+from flair_drivers import DriverBatch
+from flair_drivers import batching
+from flair_drivers import current_batch
 
 LOGGER = udi_interface.LOGGER
 VERSION = '3.0.1'
+DEFAULT_UPDATE_WORKERS = 4
+READINGS_INCLUDE = 'vents.current-reading,pucks.current-reading'
+API_ROOT = 'https://api.flair.co/'
+API_ROOT_CACHE = 'api_root_cache.json'
+TOPOLOGY_SNAPSHOT = 'topology.json'
+HISTORY_FILE = 'history.dat'
+DEFAULT_TREND_WINDOW = 3600
+BATCH_MODES = ('node', 'cycle', 'off')
+POLL_PARAMS = {'poll_structure': 'FLAIR_STRUCT', 'poll_room': 'FLAIR_ROOM',
+               'poll_vent': 'FLAIR_VENT', 'poll_puck': 'FLAIR_PUCK'}
+
+# Smallest change worth sending to the ISY for the reading drivers.
+DEADBANDS = {'CLITEMP': 0.1, 'GV7': 0.2, 'GV10': 0.1, 'GV11': 0.2,
+             'CLIHUM': 1, 'GV8': 0.05, 'GV9': 0.05, 'GV12': 2,
+             'GV13': 0.1, 'GV14': 0.005}
+
+def name_hash(name):
+    return str(int(hashlib.md5(name.encode('utf8')).hexdigest(), 16) % (10 ** 8))
+
+def load_topology(path, client_id):
+    '''
+    Read the topology saved by the last discovery, None if there is none
+    or it belongs to other credentials.
+    '''
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('client_id') != client_id:
+        return None
+    return snapshot.get('structures')
+
+def topology_index(topology):
+    '''
+    Map the Flair (type, id) of every resource in a topology to its node
+    address.  An address claimed by a second resource is left with the
+    first one, so two resources never share a node.
+    '''
+    index = {}
+    owners = {}
+    entries = []
+    for s in topology:
+        entries.append(s)
+        for r in s['rooms']:
+            entries.append(r)
+            entries.extend(r['pucks'])
+            entries.extend(r['vents'])
+    for entry in entries:
+        key = (entry['resource']['type'], entry['resource']['id'])
+        owner = owners.setdefault(entry['address'], key)
+        if owner != key:
+            LOGGER.warning('{} {} has the address of {} {}, skipping it'.format(key[0], key[1], owner[0], owner[1]))
+            continue
+        index[key] = entry['address']
+    return index
+
+def save_topology(path, client_id, topology):
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump({'client_id': client_id, 'saved-at': time.time(), 'structures': topology}, f)
+        os.replace(tmp, path)
+    except (IOError, OSError) as err:
+        LOGGER.error('save_topology: failed to write {}: {}'.format(path, err))
+
+def parse_deadbands(value):
+    '''
+    Parse the deadbands custom parameter, e.g. "CLITEMP=0.1,GV12=2", on
+    top of the defaults.
+    '''
+    deadbands = dict(DEADBANDS)
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        try:
+            driver, band = item.split('=')
+            deadbands[driver.strip().upper()] = abs(float(band))
+        except ValueError:
+            LOGGER.error('Invalid deadband {}, expected DRIVER=value'.format(item))
+    return deadbands
+
+def parse_ttls(value):
+    '''
+    Parse the cache_ttls custom parameter, seconds per resource type,
+    e.g. "structures=60,rooms=30".
+    '''
+    ttls = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        try:
+            type_, ttl = item.split('=')
+            ttls[type_.strip().lower()] = max(0, int(ttl))
+        except ValueError:
+            LOGGER.error('Invalid cache TTL {}, expected type=seconds'.format(item))
+    return ttls
 
 def get_profile_info(logger):
     pvf = 'profile/version.txt'
@@ -38,10 +157,24 @@ class Controller(udi_interface.Node):
         self.poly = polyglot
         self.name = 'Flair'
         self.queryON = False
-        self.client_id = ""
-        self.client_secret = ""
-        self.api_client = None
+        self.accounts = OrderedDict()
+        self.api_root = API_ROOT
+        self.pool_size = DEFAULT_POOL_SIZE
+        self.update_workers = DEFAULT_UPDATE_WORKERS
+        self.update_lock = Lock()
+        self.cache_size = 0
+        self.cache_ttls = {}
+        self.rate_limit = DEFAULT_RATE_LIMIT
+        self.breaker_threshold = DEFAULT_BREAKER_THRESHOLD
+        self.request_timeout = (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+        self.metrics = Metrics()
+        self.async_enabled = False
+        self.batch_drivers = 'node'
+        self.async_loop = EventLoopThread()
         self.discovery_thread = None
+        self.topology_loaded = False
+        self.scheduler = PollScheduler(self.scheduledNodes, self.updateScheduled,
+                                       paused=self.discoveryRunning)
         self.hb = 0
 
         polyglot.subscribe(polyglot.START, self.start, address)
@@ -54,24 +187,111 @@ class Controller(udi_interface.Node):
     def parameterHandler(self, params):
         self.poly.Notices.clear()
         try:
-            if 'client_id' in params:
-                self.client_id = params['client_id']
-
-            if 'client_secret' in params:
-                self.client_secret = params['client_secret']
+            self.api_root = params.get('api_root') or API_ROOT
+            self.pool_size = self.intParam(params, 'pool_size', DEFAULT_POOL_SIZE)
+            self.update_workers = self.intParam(params, 'update_workers', DEFAULT_UPDATE_WORKERS)
+            FlairNode.deadbands = parse_deadbands(params.get('deadbands'))
+            self.scheduler.intervals = self.pollIntervals(params)
+            self.cache_size = self.intParam(params, 'cache_size', 0, minimum=0)
+            self.cache_ttls = parse_ttls(params.get('cache_ttls'))
+            FlairNode.writes.delay = self.floatParam(params, 'write_delay', DEFAULT_WRITE_DELAY)
+            FlairNode.writes.optimistic = str(params.get('optimistic_writes') or 'true').lower() in ('true', 'yes', '1')
+            self.async_enabled = str(params.get('async_client') or '').lower() in ('true', 'yes', '1')
+            self.batch_drivers = str(params.get('batch_drivers') or 'node').lower()
+            if self.batch_drivers not in BATCH_MODES:
+                LOGGER.error('Invalid value for batch_drivers: {}, using node'.format(self.batch_drivers))
+                self.batch_drivers = 'node'
+            self.rate_limit = self.floatParam(params, 'rate_limit', DEFAULT_RATE_LIMIT)
+            self.breaker_threshold = self.intParam(params, 'breaker_threshold', DEFAULT_BREAKER_THRESHOLD)
+            self.request_timeout = (self.floatParam(params, 'connect_timeout', DEFAULT_CONNECT_TIMEOUT) or DEFAULT_CONNECT_TIMEOUT,
+                                    self.floatParam(params, 'read_timeout', DEFAULT_READ_TIMEOUT) or DEFAULT_READ_TIMEOUT)
+            self.setHistory(self.intParam(params, 'history_size', DEFAULT_HISTORY_SIZE, minimum=0))
+            FlairNode.trend_window = self.intParam(params, 'history_window', DEFAULT_TREND_WINDOW)
+            self.setAccounts(parse_accounts(params))
 
-            if self.client_id == "" or self.client_secret == "" :
+            if not self.accounts:
                 LOGGER.error('Flair requires \'client_id\' \'client_secret\' parameters to be specified in custom configuration.')
                 self.poly.Notices['cfg'] = 'Flair requires you specify both the client_id and client_secret custom parameters'
                 return False
             else:
                 self.heartbeat()
+                self.scheduler.start()
+                if not self.topology_loaded and self.loadTopology():
+                    return
                 self.discover()
                 
         except Exception as ex:
             LOGGER.error('Error starting Flair NodeServer: %s', str(ex))
 
 
+    def intParam(self, params, key, default, minimum=1):
+        try:
+            value = int(params.get(key) or default)
+        except ValueError:
+            LOGGER.error('Invalid value for {}: {}, using {}'.format(key, params[key], default))
+            value = default
+        return max(minimum, value)
+
+    def floatParam(self, params, key, default):
+        try:
+            value = float(params.get(key) or default)
+        except ValueError:
+            LOGGER.error('Invalid value for {}: {}, using {}'.format(key, params[key], default))
+            value = default
+        return max(0, value)
+
+    def pollIntervals(self, params):
+        '''
+        Poll interval in seconds of each node class, 0 leaves the class to
+        be refreshed through its structure only.
+        '''
+        intervals = dict(DEFAULT_INTERVALS)
+        for key, nodedef in POLL_PARAMS.items():
+            if not params.get(key):
+                continue
+            try:
+                intervals[nodedef] = max(0, int(params[key]))
+            except ValueError:
+                LOGGER.error('Invalid value for {}: {}, using {}'.format(key, params[key], intervals[nodedef]))
+        return intervals
+
+    def setHistory(self, size):
+        if FlairNode.history is not None:
+            if FlairNode.history.capacity == size:
+                return
+            FlairNode.history.close()
+            FlairNode.history = None
+        if size:
+            try:
+                FlairNode.history = History(HISTORY_FILE, size)
+            except (IOError, OSError, ValueError) as err:
+                LOGGER.error('Reading history disabled, failed to open {}: {}'.format(HISTORY_FILE, err))
+
+    def setAccounts(self, credentials):
+        '''
+        Bring the accounts in line with the credentials parameters.  An
+        account whose key is still there keeps its clients, token and
+        workers; the ones removed are closed.
+        '''
+        accounts = OrderedDict()
+        for key, (client_id, client_secret) in credentials.items():
+            if client_id == "" or client_secret == "":
+                if key:
+                    LOGGER.error('Flair account {} needs both client_id_{} and client_secret_{}, skipping it'.format(key, key, key))
+                    self.poly.Notices['cfg_' + key] = 'Flair account {} needs both the client_id_{} and client_secret_{} custom parameters'.format(key, key, key)
+                continue
+            account = self.accounts.get(key) or Account(key, client_id, client_secret,
+                                                        metrics=self.metrics, api_root_cache=API_ROOT_CACHE)
+            account.configure(client_id, client_secret, self.api_root, self.pool_size, self.update_workers,
+                              self.rate_limit, self.cache_size, self.cache_ttls, self.breaker_threshold,
+                              self.request_timeout)
+            accounts[key] = account
+        for key, account in self.accounts.items():
+            if key not in accounts:
+                LOGGER.info('Removing Flair {}'.format(account))
+                account.close(self.async_loop)
+        self.accounts = accounts
+
     def start(self):
         self.poly.updateProfile()
         self.poly.setCustomParamsDoc()
@@ -82,29 +302,23 @@ class Controller(udi_interface.Node):
             
     def poll(self, pollflag):
         if 'shortPoll' in pollflag:
-            try:
-                if self.discovery_thread is not None:
-                    if self.discovery_thread.is_alive():
-                        LOGGER.debug('Skipping shortPoll() while discovery in progress...')
-                        return
-                    else:
-                        self.discovery_thread = None
-                self.update()
-            except Exception as ex:
-                LOGGER.error('Error shortPoll: %s', str(ex))
+            # Nodes are refreshed by the scheduler on their own intervals,
+            # shortPoll only makes sure it is still running.
+            if self.accounts:
+                self.scheduler.start()
         else:
             try :
                 self.heartbeat()
+                self.metrics.log_summary()
+                self.publishMetrics()
+                if FlairNode.history is not None:
+                    FlairNode.history.flush()
                 if self.discovery_thread is not None:
                     if self.discovery_thread.is_alive():
                         LOGGER.debug('Skipping longPoll() while discovery in progress...')
                         return	
                     else: 
                         self.discovery_thread = None	
-                    
-                # Renew Token
-                self.api_client.oauth_token()
-                self.api_client.api_root_response()
             except Exception as ex:
                 LOGGER.error('Error longPoll: %s', str(ex))
     
@@ -122,13 +336,126 @@ class Controller(udi_interface.Node):
             node.reportDrivers()
             
     def update(self):
+        if not self.update_lock.acquire(blocking=False):
+            LOGGER.debug('Skipping update() while previous cycle is still running...')
+            self.metrics.skip_cycle()
+            return
         try :
-            self.setDriver('ST', 1)
-            for node in self.poly.nodes():
-                if node.queryON == True :
-                    node.update()
+            nodes = [node for node in self.poly.nodes() if node.queryON == True]
+            cycle = self.runCycle(nodes)
+            LOGGER.info('Updated {} nodes in {:.2f}s with {} requests'.format(len(nodes), cycle['ms'] / 1000.0, cycle['requests']))
         except Exception as ex:
             LOGGER.error('Error update: %s', str(ex))
+        finally:
+            self.update_lock.release()
+
+    def discoveryRunning(self):
+        return self.discovery_thread is not None and self.discovery_thread.is_alive()
+
+    def scheduledNodes(self):
+        return [node for node in self.poly.nodes() if isinstance(node, FlairNode)]
+
+    def updateScheduled(self, nodes):
+        if not self.update_lock.acquire(blocking=False):
+            LOGGER.debug('Skipping scheduled update while another cycle is still running...')
+            self.metrics.skip_cycle()
+            return False
+        try:
+            cycle = self.runCycle(nodes)
+            LOGGER.debug('Scheduler updated {} nodes in {} ms with {} requests'.format(len(nodes), cycle['ms'], cycle['requests']))
+        finally:
+            self.update_lock.release()
+
+    def runCycle(self, nodes):
+        '''
+        Refresh the nodes and record the cycle's wall time and requests.
+        Callers hold update_lock.
+        '''
+        start = self.metrics.cycle()
+        started = time.monotonic()
+        # Accounts whose API is failing are left out, their nodes keep
+        # the last values they had.
+        accounts = set(account for account in self.accounts.values() if account.ready())
+        nodes = [node for node in nodes if node.account in accounts]
+        # Structures go first, their compound fetch hands the current
+        # readings to the vent and puck nodes refreshed after them.
+        structures = [node for node in nodes if isinstance(node, FlairStructure)]
+        # With batch_drivers=cycle every driver change of the cycle goes
+        # out in one message at the end.
+        batch = DriverBatch() if self.batch_drivers == 'cycle' else None
+        clients = dict((node.account, self.getAsyncClient(node.account)) for node in structures)
+        if structures and None not in clients.values():
+            self.async_loop.run(self.updateStructuresAsync(structures, clients, batch))
+        else:
+            self.updateNodes(structures, batch)
+        self.updateNodes([node for node in nodes if node not in structures], batch)
+        if batch is not None:
+            batch.flush()
+        cycle = self.metrics.end_cycle(start, time.monotonic() - started, len(nodes))
+        self.setDriver('ST', 1 if self.connected() else 0)
+        return cycle
+
+    def publishMetrics(self):
+        '''
+        Show the last cycle on the controller.  Done on longPoll only, the
+        cycle time changes on every scheduler pass.
+        '''
+        cycle = self.metrics.last_cycle
+        self.setDriver('GV1', cycle['ms'])
+        self.setDriver('GV2', cycle['requests'])
+        self.setDriver('GV3', self.metrics.error_rate())
+
+    def connected(self):
+        '''
+        Whether the Flair API answers every account, ST shows this.
+        '''
+        return bool(self.accounts) and all(account.breaker.closed() for account in self.accounts.values())
+
+    def updateNodes(self, nodes, batch=None):
+        # Each node refresh is one blocking API round trip, so run them
+        # side by side on the bounded pool of the node's account.
+        for future in [node.account.submit(self.updateNode, node, batch) for node in nodes]:
+            future.result()
+
+    async def updateStructuresAsync(self, structures, clients, batch=None):
+        await asyncio.gather(*[self.updateNodeAsync(node, clients[node.account], batch) for node in structures])
+
+    def nodeBatch(self, batch):
+        '''
+        The batch a node update stages its drivers in: the cycle's, a
+        new one for the node alone, or None when batching is off.
+        '''
+        if batch is None and self.batch_drivers == 'node':
+            return DriverBatch()
+        return batch
+
+    async def updateNodeAsync(self, node, client, batch=None):
+        start = time.monotonic()
+        own = self.nodeBatch(batch)
+        # Each gathered task has its own context, so the batch is the
+        # node's even though the tasks share the loop's thread.
+        with batching(own):
+            try:
+                await node.updateAsync(client)
+            except Exception as ex:
+                LOGGER.error('Error updating {}: {}'.format(node.name, str(ex)))
+                node.discardDrivers()
+        if own is not None and own is not batch:
+            own.flush()
+        self.metrics.record_node(node.address, time.monotonic() - start)
+
+    def updateNode(self, node, batch=None):
+        start = time.monotonic()
+        own = self.nodeBatch(batch)
+        with batching(own):
+            try:
+                node.update()
+            except Exception as ex:
+                LOGGER.error('Error updating {}: {}'.format(node.name, str(ex)))
+                node.discardDrivers()
+        if own is not None and own is not batch:
+            own.flush()
+        self.metrics.record_node(node.address, time.monotonic() - start)
     
     def runDiscover(self,command):
         self.discover()
@@ -141,56 +468,327 @@ class Controller(udi_interface.Node):
         self.discovery_thread = Thread(target=self._discovery_process)
         self.discovery_thread.start()
 
+    def getAsyncClient(self, account):
+        '''
+        The asyncio client structures of account are refreshed with when
+        the async_client parameter is set, None otherwise.
+        '''
+        if not self.async_enabled:
+            return None
+        try:
+            return account.get_async_client(self.async_loop)
+        except ImportError as ex:
+            LOGGER.error('Async client unavailable, using threads: {}'.format(ex))
+            self.async_enabled = False
+            return None
+
+    def loadTopology(self):
+        '''
+        Rebuild the nodes from the last discovery's snapshots, then refresh
+        them and re-run discovery in the background to catch changes.
+        '''
+        restored = False
+        for account in self.accounts.values():
+            path = account.snapshot(TOPOLOGY_SNAPSHOT)
+            topology = load_topology(path, account.client_id)
+            if not topology:
+                continue
+            LOGGER.info('Restoring {} structure(s) of {} from {}'.format(len(topology), account, path))
+            account.index = topology_index(topology)
+            self.addTopology(account, topology)
+            restored = True
+        if not restored:
+            return False
+        self.topology_loaded = True
+        # Tracked like any discovery, so discover() and longPoll wait for
+        # it and the scheduler holds off until it is done.
+        self.discovery_thread = Thread(target=self._validate_topology)
+        self.discovery_thread.start()
+        return True
+
+    def _validate_topology(self):
+        self.update()
+        self._discovery_process()
+
+    def addTopology(self, account, topology):
+        '''
+        Add the nodes of an account's topology, except the ones
+        topology_index left out of its index.
+        '''
+        client = account.get_client()
+        indexed = lambda e: account.index.get((e['resource']['type'], e['resource']['id'])) == e['address']
+
+        def add(node):
+            node.account = account
+            self.poly.addNode(node)
+
+        for s in filter(indexed, topology):
+            structure = client.create_model(**s['resource'])
+            add(FlairStructure(self.poly, s['address'], s['address'], s['name'], structure))
+            for r in filter(indexed, s['rooms']):
+                room = client.create_model(**r['resource'])
+                add(FlairRoom(self.poly, s['address'], r['address'], r['name'], room))
+                for p in filter(indexed, r['pucks']):
+                    add(FlairPuck(self.poly, s['address'], p['address'], p['name'], client.create_model(**p['resource']), room))
+                for v in filter(indexed, r['vents']):
+                    add(FlairVent(self.poly, s['address'], v['address'], v['name'], client.create_model(**v['resource']), room))
+
+    def nodeAddress(self, account, resource, prefix, used):
+        '''
+        Keep the address a resource already has, so renaming it in the
+        Flair app doesn't orphan its node.  New resources get the name
+        hash, or a hash of their id when another resource has that one.
+        '''
+        key = (resource.type_, resource.id_)
+        address = account.index.get(key) or prefix + name_hash(resource.attributes['name'])
+        if used.setdefault(address, key) != key:
+            address = prefix + name_hash(resource.type_ + '/' + str(resource.id_))
+            used[address] = key
+        return address
+
+    def getDevices(self, args):
+        room, rel = args
+        try:
+            return list(room.get_rel(rel).all())
+        except EmptyBodyException:
+            return []
+
+    def mapWorkers(self, account, fn, items):
+        if account.workers > 1 and len(items) > 1:
+            with ThreadPoolExecutor(max_workers=account.workers, thread_name_prefix='discovery') as executor:
+                return iter(list(executor.map(fn, items)))
+        return iter([fn(item) for item in items])
+
     def _discovery_process(self):
+        for account in list(self.accounts.values()):
+            if not account.ready():
+                LOGGER.warning('Skipping discovery of Flair {} while its API is failing'.format(account))
+                continue
+            self.discoverAccount(account)
+
+    def discoverAccount(self, account):
         
         try:
-            self.api_client = make_client(self.client_id,self.client_secret,'https://api.flair.co/')
-            structures = self.api_client.get('structures')
+            structures = account.get_client().get('structures')
         except ApiError as ex:
             LOGGER.error('Error _discovery_process: %s', str(ex))
-            
-        for structure in structures:
-            strHash = str(int(hashlib.md5(structure.attributes['name'].encode('utf8')).hexdigest(), 16) % (10 ** 8))
-            self.poly.addNode(FlairStructure(self.poly, strHash, strHash,structure.attributes['name'],structure))
-            #time.sleep(5)
-            rooms = structure.get_rel('rooms')
+            return
+
+        topology = []
+        # Addresses of known resources stay reserved for them.
+        used = dict((address, key) for key, address in account.index.items())
+        for structure in structures.all():
+            strHash = self.nodeAddress(account, structure, account.prefix, used)
+            entry = {'address': strHash, 'name': structure.attributes['name'], 'resource': structure.to_dict(), 'rooms': []}
+            topology.append(entry)
+            rooms = list(structure.get_rel('rooms').all())
+            # One request per room and relationship, fetched side by side;
+            # map() keeps the results in room order so names and addresses
+            # come out the same as a serial walk.
+            devices = self.mapWorkers(account, self.getDevices, [(room, rel) for room in rooms for rel in ('pucks', 'vents')])
             roomNumber = 1
             for room in rooms:
-                strHashRoom = str(int(hashlib.md5(room.attributes['name'].encode('utf8')).hexdigest(), 16) % (10 ** 8))
-                self.poly.addNode(FlairRoom(self.poly, strHash,strHashRoom,'R' + str(roomNumber) + '_' + room.attributes['name'],room))
-                
-                try:
-                    pucks = room.get_rel('pucks')
-                    for puck in pucks:
-                        strHashPucks = str(int(hashlib.md5(puck.attributes['name'].encode('utf8')).hexdigest(), 16) % (10 ** 8))
-                        self.poly.addNode(FlairPuck(self.poly, strHash,strHashRoom[:4]+strHashPucks,'R' + str(roomNumber) + '_' + puck.attributes['name'],puck,room))
-                except EmptyBodyException as ex:
-                    pass
-            
-                try:
-                    vents = room.get_rel('vents')
-                    for vent in vents :
-                        strHashVents = str(int(hashlib.md5(vent.attributes['name'].encode('utf8')).hexdigest(), 16) % (10 ** 8))
-                        self.poly.addNode(FlairVent(self.poly, strHash, strHashRoom[:4]+strHashVents ,'R' + str(roomNumber) + '_' + vent.attributes['name'],vent,room))
-                except EmptyBodyException as ex:
-                    pass
+                strHashRoom = self.nodeAddress(account, room, account.prefix, used)
+                roomEntry = {'address': strHashRoom, 'name': 'R' + str(roomNumber) + '_' + room.attributes['name'], 'resource': room.to_dict(), 'pucks': [], 'vents': []}
+                entry['rooms'].append(roomEntry)
+
+                for puck in next(devices):
+                    roomEntry['pucks'].append({'address': self.nodeAddress(account, puck, strHashRoom[:4], used), 'name': 'R' + str(roomNumber) + '_' + puck.attributes['name'], 'resource': puck.to_dict()})
+
+                for vent in next(devices):
+                    roomEntry['vents'].append({'address': self.nodeAddress(account, vent, strHashRoom[:4], used), 'name': 'R' + str(roomNumber) + '_' + vent.attributes['name'], 'resource': vent.to_dict()})
                 
                 roomNumber = roomNumber + 1
+
+        account.index = topology_index(topology)
+        self.addTopology(account, topology)
+        save_topology(account.snapshot(TOPOLOGY_SNAPSHOT), account.client_id, topology)
                            
     def delete(self):
         LOGGER.info('Deleting Flair')
+        self.scheduler.stop()
+        FlairNode.writes.flush_all()
+        self.setHistory(0)
+        accounts, self.accounts = self.accounts, OrderedDict()
+        for account in accounts.values():
+            account.close(self.async_loop)
+        self.async_loop.stop()
         
     id = 'controller'
     commands = {    'QUERY': query,        
                     'DISCOVERY' : runDiscover
                }
-    drivers = [{'driver': 'ST', 'value': 0, 'uom': 2}]
+    drivers = [{'driver': 'ST', 'value': 0, 'uom': 2},
+               {'driver': 'GV1', 'value': 0, 'uom': 42, 'name': 'Last Cycle'},
+               {'driver': 'GV2', 'value': 0, 'uom': 56, 'name': 'Requests per Cycle'},
+               {'driver': 'GV3', 'value': 0, 'uom': 51, 'name': 'Error Rate'}]
     
-class FlairStructure(udi_interface.Node):
+class WriteState(object):
+    '''
+    The optimistic writes of one driver still waiting for Flair, and the
+    last value Flair accepted for it.
+    '''
+    __slots__ = ('outstanding', 'generation', 'accepted', 'accepted_generation', 'failed')
+
+    def __init__(self, accepted):
+        self.outstanding = 0
+        self.generation = 0
+        self.accepted = accepted
+        self.accepted_generation = 0
+        self.failed = None
+
+
+class FlairNode(udi_interface.Node):
+    '''
+    Base of the Flair nodes.  Readings go through publish(), which only
+    sends a driver when it moved past its deadband since the last value
+    sent.  reportDrivers() still sends the latest reading of every driver.
+    During a node update driver changes are staged in the update's
+    DriverBatch and reported together when it is done.
+    '''
+    deadbands = DEADBANDS
+    # The Account the node's resources belong to, set when it is added.
+    account = None
+    # Recent readings of vents and pucks, see flair_history.History.
+    history = None
+    trend_window = DEFAULT_TREND_WINDOW
+    writes = WriteCoalescer()
+
+    def __init__(self, controller, primary, address, name):
+        super(FlairNode, self).__init__(controller, primary, address, name)
+        self.latest = {}
+        # Outstanding optimistic writes by driver, see write().
+        self.writing = {}
+        self.write_lock = Lock()
+        # When a command's value was last shown, by driver.
+        self.acknowledged = {}
+
+    def publish(self, driver, value):
+        if driver in self.writing:
+            # A commanded value is still being written, readings taken
+            # before it landed would flip the driver back.
+            return False
+        self.latest[driver] = value
+        last = self.getDriver(driver)
+        if last is not None and value is not None:
+            try:
+                if abs(float(value) - float(last)) < self.deadbands.get(driver, 0):
+                    return False
+            except (TypeError, ValueError):
+                pass
+        return self.setDriver(driver, value)
+
+    def write(self, resource, attributes, driver, value, value_of):
+        '''
+        Queue the write of a command.  With optimistic writes the driver
+        shows the commanded value right away; when the latest write to it
+        lands it follows what the API stored, value_of() picks that out of
+        the resource's attributes.  If the latest write fails the driver
+        goes back to the last value Flair accepted once no other write to
+        it is outstanding.
+        '''
+        if not self.writes.optimistic:
+            def written(result):
+                if not isinstance(result, Exception):
+                    self.acknowledge(driver, value_of(result.attributes))
+            self.writes.write(resource, attributes, written)
+            return
+
+        with self.write_lock:
+            state = self.writing.get(driver)
+            if state is None:
+                state = self.writing[driver] = WriteState(self.latest.get(driver, self.getDriver(driver)))
+            state.outstanding += 1
+            state.generation += 1
+            generation = state.generation
+            self.acknowledge(driver, value)
+
+        def written(result):
+            with self.write_lock:
+                state.outstanding -= 1
+                latest = generation == state.generation
+                if not isinstance(result, Exception):
+                    stored = value_of(result.attributes)
+                    if generation > state.accepted_generation:
+                        state.accepted, state.accepted_generation = stored, generation
+                    if latest:
+                        state.failed = None
+                        self.acknowledge(driver, stored)
+                elif latest:
+                    state.failed = result
+                if state.outstanding:
+                    return
+                del self.writing[driver]
+                if state.failed is not None:
+                    LOGGER.warning('{}: write of {} failed, back to {}'.format(self.name, driver, state.accepted))
+                    self.acknowledge(driver, state.accepted)
+                    self.poly.Notices['write_' + self.address] = \
+                        'Flair did not accept the last command to {}: {}'.format(self.name, str(state.failed))
+                elif 'write_' + self.address in self.poly.Notices:
+                    self.poly.Notices.delete('write_' + self.address)
+        self.writes.write(resource, attributes, written)
+
+    def record(self, timestamp, values):
+        '''
+        Add a reading to the node's history, if one is kept.
+        '''
+        if self.history is not None and timestamp is not None:
+            self.history.record(self.address, timestamp, values)
+
+    def publishTrend(self, driver, field, window, per):
+        '''
+        Publish the slope of field over window seconds of history, in
+        units per per seconds.
+        '''
+        if self.history is None:
+            return
+        aggregate = self.history.aggregate(self.address, field, window)
+        if aggregate is not None and aggregate.count > 1:
+            self.publish(driver, round(aggregate.slope * per, 3))
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None, text=None):
+        batch = current_batch()
+        if batch is None or not report:
+            return super(FlairNode, self).setDriver(driver, value, report=report, force=force, uom=uom, text=text)
+        batch.stage(self, driver, value, force, uom, text)
+        return True
+
+    def driverStatus(self, driver):
+        '''
+        The entry of a status message that reports driver, as
+        Node.reportDriver() sends it.
+        '''
+        for d in self.drivers:
+            if d['driver'] == driver:
+                return {'address': self.address, 'driver': driver, 'value': str(d['value']),
+                        'uom': d['uom'], 'text': d.get('text')}
+
+    def discardDrivers(self):
+        '''
+        Drop the driver changes staged by an update that failed.
+        '''
+        batch = current_batch()
+        if batch is not None:
+            batch.discard(self)
+
+    def acknowledge(self, driver, value):
+        # Values staged before this are stale, see DriverBatch.flush().
+        self.acknowledged[driver] = time.monotonic()
+        self.latest[driver] = value
+        self.setDriver(driver, value)
+
+    def reportDrivers(self):
+        for driver, value in list(self.latest.items()):
+            self.setDriver(driver, value, report=False)
+        super(FlairNode, self).reportDrivers()
+
+class FlairStructure(FlairNode):
 
     SPM = ['Home Evenness For Active Rooms Flair Setpoint','Home Evenness For Active Rooms Follow Third Party']
     HAM = ['Manual','Third Party Home Away','Flair Autohome Autoaway']
     MODE = ['manual','auto']
+    # Structure drivers are settings, every change is sent.
+    deadbands = {}
     
     def __init__(self, controller, primary, address, name, struct):
 
@@ -198,107 +796,166 @@ class FlairStructure(udi_interface.Node):
         self.queryON = True
         self.name = name
         self.objStructure = struct
+        self.includeReadings = True
    
     def setMode(self, command):
-        try :
-            self.objStructure.update(attributes={'mode': self.MODE[int(command.get('value'))]})  
-            self.setDriver('GV4', self.MODE.index(self.objStructure.attributes['mode']))
-        except ApiError as ex:
-            LOGGER.error('Error setMode: %s', str(ex))
+        value = int(command.get('value'))
+        self.write(self.objStructure, {'mode': self.MODE[value]}, 'GV4', value,
+                   lambda attributes: self.MODE.index(attributes['mode']))
        
     def setAway(self, command):
-        try:
-            self.objStructure.update(attributes={'home-away-mode': self.HAM[int(command.get('value'))]})
-            self.setDriver('GV5', self.HAM.index(self.objStructure.attributes['home-away-mode']))
-        except ApiError as ex:
-            LOGGER.error('Error setAway: %s', str(ex))
+        value = int(command.get('value'))
+        self.write(self.objStructure, {'home-away-mode': self.HAM[value]}, 'GV5', value,
+                   lambda attributes: self.HAM.index(attributes['home-away-mode']))
     
     def setEven(self, command):
-        try:    
-            self.objStructure.update(attributes={'set-point-mode': self.SPM[int(command.get('value'))]})
-            self.setDriver('GV6', self.SPM.index(self.objStructure.attributes['set-point-mode']))
-        except ApiError as ex:
-            LOGGER.error('Error setEven: %s', str(ex))
+        value = int(command.get('value'))
+        self.write(self.objStructure, {'set-point-mode': self.SPM[value]}, 'GV6', value,
+                   lambda attributes: self.SPM.index(attributes['set-point-mode']))
     
     def query(self):
         self.reportDrivers()
         
-    def update(self):
+    def getRooms(self):
         '''
-        This appears to just send the data we got during discovery.  Nothing
-        here is being updated.
+        Fetch the rooms together with every vent and puck current-reading
+        in one compound request.  If the API refuses the include, fall
+        back to the plain room list and let each device fetch its own.
         '''
+        if self.includeReadings:
+            try:
+                return self.objStructure.get_rel('rooms', include=READINGS_INCLUDE)
+            except ApiError as ex:
+                if ex.status_code != 400:
+                    raise
+                LOGGER.warning('Compound room fetch not supported, fetching readings per device')
+                self.includeReadings = False
+        return self.objStructure.get_rel('rooms')
+
+    def nodeFor(self, resource):
+        address = self.account.index.get((resource.type_, resource.id_))
+        return self.poly.getNode(address) if address is not None else None
+
+    def dispatchReadings(self, room, adopt=None):
+        for rel in ('vents', 'pucks'):
+            devices = room.get_included(rel)
+            if devices is None:
+                continue
+            for device in devices:
+                node = self.nodeFor(device)
+                reading = device.get_included('current-reading')
+                if node is not None and reading is not None:
+                    node.setReading(adopt(device) if adopt else device, reading, self.address)
+
+    def update(self):
         try:
-            rooms = self.objStructure.get_rel('rooms')
-            for room in rooms:
-                '''
-                Here's what we have for each room.  How do we map this to
-                the room nodes?
-                {
-                'name': 'Guest Room',
-                'created-at': '2024-06-29T01:38:25.448999+00:00',
-                'set-point-c': 18.33,
-                'pucks-inactive': 'Active',
-                'room-type': None,
-                'active': True, 
-                'updated-at': '2025-01-21T23:00:18.335236+00:00', 
-                'hold-until-schedule-event': True, 
-                'humidity-away-max': 80, 
-                'room-conclusion-mode': 'HEAT', 
-                'windows': None, 
-                'temp-away-min-c': 16.0, 
-                'state-updated-at': '2025-01-21T16:26:57.771938+00:00', 
-                'frozen-pipe-pet-protect': True, 
-                'level': None, 
-                'occupancy-mode': 'Flair Auto', 
-                'set-point-manual': True, 
-                'preheat-precool': True, 
-                'current-humidity': 28.0, 
-                'temp-away-max-c': 22.5, 
-                'hold-reason': 'Set by Dale', 
-                'current-temperature-c': 17.73, 
-                'air-return': False, 
-                'heat-cool-mode': 'HEAT', 
-                'hold-until': None, 
-                'room-away-mode': 'Smart Away', 
-                'humidity-away-min': 10}
-                '''
-                LOGGER.debug('RAW Room: {}'.format(room.attributes))
-                strHashRoom = str(int(hashlib.md5(room.attributes['name'].encode('utf8')).hexdigest(), 16) % (10 ** 8))
-                rnode = self.poly.getNode(strHashRoom)
+            self.objStructure.get_self()
+            self.apply(self.getRooms().all())
+        except ApiError as ex:
+            LOGGER.error('Error query: %s', str(ex))
+            self.discardDrivers()
 
-                # temperature (c and f), humidity, setpoint 
-                rnode.new_update(room.attributes['current-temperature-c'], room.attributes['current-humidity'], room.attributes['set-point-c'])
+    async def getRoomsAsync(self, structure):
+        if self.includeReadings:
+            try:
+                rooms = await structure.get_rel('rooms', include=READINGS_INCLUDE)
+                return [room async for room in rooms.all()]
+            except ApiError as ex:
+                if ex.status_code != 400:
+                    raise
+                LOGGER.warning('Compound room fetch not supported, fetching readings per device')
+                self.includeReadings = False
+        rooms = await structure.get_rel('rooms')
+        return [room async for room in rooms.all()]
 
+    async def updateAsync(self, client):
+        '''
+        update() as one task on the async client, the structure and its
+        rooms with their readings are requested side by side.  Devices
+        handed to the vent and puck nodes are turned back into blocking
+        models so their commands keep working.
+        '''
+        try:
+            structure = client.create_model(**self.objStructure.to_dict())
+            _, rooms = await asyncio.gather(structure.get_self(), self.getRoomsAsync(structure))
+            # Through merge(), a body older than a write that landed
+            # meanwhile is ignored.
+            self.objStructure.merge(structure.attributes, {})
+            sync = self.objStructure.client
+            self.apply(rooms, adopt=lambda device: sync.create_model(**device.to_dict()))
+        except ApiError as ex:
+            LOGGER.error('Error query: %s', str(ex))
+            self.discardDrivers()
 
+    def apply(self, rooms, adopt=None):
+        '''
+        Publish the structure and hand each room and device its reading.
+        '''
+        for room in rooms:
             '''
-            Not sure why this is being done.  As far as I can tell, these values
-            are never queried after discovery.
+            Here's what we have for each room.  How do we map this to
+            the room nodes?
+            {
+            'name': 'Guest Room',
+            'created-at': '2024-06-29T01:38:25.448999+00:00',
+            'set-point-c': 18.33,
+            'pucks-inactive': 'Active',
+            'room-type': None,
+            'active': True, 
+            'updated-at': '2025-01-21T23:00:18.335236+00:00', 
+            'hold-until-schedule-event': True, 
+            'humidity-away-max': 80, 
+            'room-conclusion-mode': 'HEAT', 
+            'windows': None, 
+            'temp-away-min-c': 16.0, 
+            'state-updated-at': '2025-01-21T16:26:57.771938+00:00', 
+            'frozen-pipe-pet-protect': True, 
+            'level': None, 
+            'occupancy-mode': 'Flair Auto', 
+            'set-point-manual': True, 
+            'preheat-precool': True, 
+            'current-humidity': 28.0, 
+            'temp-away-max-c': 22.5, 
+            'hold-reason': 'Set by Dale', 
+            'current-temperature-c': 17.73, 
+            'air-return': False, 
+            'heat-cool-mode': 'HEAT', 
+            'hold-until': None, 
+            'room-away-mode': 'Smart Away', 
+            'humidity-away-min': 10}
             '''
-            if  self.objStructure.attributes['is-active'] is True:
-                self.setDriver('GV2', 1)
+            LOGGER.debug('RAW Room: {}'.format(room.attributes))
+            rnode = self.nodeFor(room)
+            if rnode is not None:
+                # temperature (c and f), humidity, setpoint 
+                rnode.new_update(room.attributes['current-temperature-c'], room.attributes['current-humidity'], room.attributes['set-point-c'])
             else:
-                self.setDriver('GV2', 0)
-            
-            tempC = float(self.objStructure.attributes['set-point-temperature-c'])
-            tempF = (tempC * 9/5) + 32
-            LOGGER.error('STRUCTURE: {} / {} / {} -- {}'.format(self.name, tempC, tempF, self.objStructure.attributes['created-at']))
-            
-            self.setDriver('CLISPC', round(tempC,1))
-            self.setDriver('GV7', round(tempF,1))
+                LOGGER.debug('No node for room {}, run discovery to add it'.format(room.attributes['name']))
 
-            if  self.objStructure.attributes['home'] is True:
-                self.setDriver('GV3', 1)
-            else:
-                self.setDriver('GV3', 0)
+            if self.includeReadings:
+                self.dispatchReadings(room, adopt)
 
-            self.setDriver('GV6', self.SPM.index(self.objStructure.attributes['set-point-mode']))
-            self.setDriver('GV5', self.HAM.index(self.objStructure.attributes['home-away-mode']))
-            self.setDriver('GV4', self.MODE.index(self.objStructure.attributes['mode']))
-            
-        except ApiError as ex:
-            LOGGER.error('Error query: %s', str(ex))
-            
+        if  self.objStructure.attributes['is-active'] is True:
+            self.publish('GV2', 1)
+        else:
+            self.publish('GV2', 0)
+        
+        tempC = float(self.objStructure.attributes['set-point-temperature-c'])
+        tempF = (tempC * 9/5) + 32
+        LOGGER.error('STRUCTURE: {} / {} / {} -- {}'.format(self.name, tempC, tempF, self.objStructure.attributes['created-at']))
+        
+        self.publish('CLISPC', round(tempC,1))
+        self.publish('GV7', round(tempF,1))
+
+        if  self.objStructure.attributes['home'] is True:
+            self.publish('GV3', 1)
+        else:
+            self.publish('GV3', 0)
+
+        self.publish('GV6', self.SPM.index(self.objStructure.attributes['set-point-mode']))
+        self.publish('GV5', self.HAM.index(self.objStructure.attributes['home-away-mode']))
+        self.publish('GV4', self.MODE.index(self.objStructure.attributes['mode']))
+        
     drivers = [{'driver': 'GV2', 'value': 0, 'uom': 2, 'name': 'Status'},
                {'driver': 'CLISPC', 'value': 0, 'uom': 4, 'name': 'Setpoint C'},
                {'driver': 'GV3', 'value': 0, 'uom': 2, 'name': 'Home'},
@@ -313,7 +970,7 @@ class FlairStructure(udi_interface.Node):
                 'SET_EVENESS' : setEven,
                 'QUERY': query }
    
-class FlairVent(udi_interface.Node):
+class FlairVent(FlairNode):
 
     def __init__(self, controller, primary, address, name, vent,room):
 
@@ -322,63 +979,80 @@ class FlairVent(udi_interface.Node):
         self.name = name
         self.objVent = vent
         self.objRoom = room
+        self.reading = None
+        self.readingAt = None
+        # Address of the structure node whose fetch hands us readings,
+        # and whether the last update used one, see PollScheduler.
+        self.supplier = None
+        self.supplied = False
         
     def setOpen(self, command):
-        
-        try:
-            self.objVent.update(attributes={'percent-open': int(command.get('value'))})
-            self.setDriver('GV1', self.objVent.attributes['percent-open'])
-        except ApiError as ex:
-            LOGGER.error('Error setOpen: %s', str(ex))
+        value = int(command.get('value'))
+        self.write(self.objVent, {'percent-open': value}, 'GV1', value,
+                   lambda attributes: attributes['percent-open'])
 
     def query(self):
         self.reportDrivers()           
-            
-    def update(self):
-        '''
-        From what I can tell objVent is the data we got during discovery. 
-        We really need to make a call to the API to get updated data and
-        use that.
 
-        objVent.get_rel() seems to get updated data (I.E. calls the API)
-        but it doesn't seem to populate objVent.attributes with it.
-          - duct-temperature-c
-          - duct-pressure
-          - precent-open
-          - system-voltage
-          - rssi
+    def setReading(self, vent, reading, supplier=None):
+        self.objVent = vent
+        self.reading = reading
+        self.supplier = supplier
+
+    def getReading(self):
+        '''
+        Use the reading the structure prefetched this cycle, otherwise
+        fetch current-reading for this vent only.
         '''
+        reading, self.reading = self.reading, None
+        self.supplied = reading is not None
+        if reading is None:
+            reading = self.objVent.get_rel('current-reading')
+        return reading
+            
+    def update(self):
 
         try:
             if  self.objVent.attributes['inactive'] is True:
-                self.setDriver('GV2', 1)
+                self.publish('GV2', 1)
             else:
-                self.setDriver('GV2', 0)
+                self.publish('GV2', 0)
 
             # Get current-reading
-            creading = self.objVent.get_rel('current-reading')
+            creading = self.getReading()
             cat = creading.attributes
             LOGGER.debug('VENT raw = {}'.format(cat))
             LOGGER.info('VENT: {} - {} {} {} {} {} {}'.format(self.name, cat['duct-temperature-c'], cat['duct-pressure'], cat['percent-open'], cat['system-voltage'], cat['rssi'], cat['created-at']))
 
-            self.setDriver('GV1', cat['percent-open'])
-            self.setDriver('GV8', cat['system-voltage'])
+            self.readingAt = parse_timestamp(cat['created-at'])
+            self.publish('GV1', cat['percent-open'])
+            self.publish('GV8', cat['system-voltage'])
 
-            self.setDriver('GV9', cat['duct-pressure'])
+            self.publish('GV9', cat['duct-pressure'])
             
             if 'duct-temperature-c' in cat:
                 tempC = float(cat['duct-temperature-c'])
                 tempF = (tempC * 9/5) + 32
             
-                self.setDriver('GV10', round(tempC,2))
-                self.setDriver('GV11', round(tempF,2))
+                self.publish('GV10', round(tempC,2))
+                self.publish('GV11', round(tempF,2))
+
+            self.publish('GV12', cat['rssi'])
 
-            self.setDriver('GV12', cat['rssi'])
+            self.record(self.readingAt, {'temperature': cat.get('duct-temperature-c'),
+                                         'pressure': cat['duct-pressure'],
+                                         'percent-open': cat['percent-open'],
+                                         'voltage': cat['system-voltage'],
+                                         'rssi': cat['rssi']})
+            self.publishTrend('GV13', 'temperature', self.trend_window, 3600)
+            self.publishTrend('GV14', 'voltage', None, 86400)
         
         except ApiError as ex:
             LOGGER.error('Error query: %s', str(ex))
+            self.discardDrivers()
         except Exception as err:
             LOGGER.error('Error vent update: %s', str(err))
+            self.discardDrivers()
              
     drivers = [{'driver': 'GV2', 'value': 0, 'uom': 2, 'name': 'Status'},
                {'driver': 'GV1', 'value': 0, 'uom': 51, 'name': 'Open'},
@@ -386,13 +1060,15 @@ class FlairVent(udi_interface.Node):
                {'driver': 'GV9', 'value': 0, 'uom': 31, 'name': 'Pressure'},
                {'driver': 'GV10', 'value': 0, 'uom': 4, 'name': 'Temperature C'},
                {'driver': 'GV11', 'value': 0, 'uom': 17, 'name': 'Temperature F'},
-               {'driver': 'GV12', 'value': 0, 'uom': 56, 'name': 'rssi'}]
+               {'driver': 'GV12', 'value': 0, 'uom': 56, 'name': 'rssi'},
+               {'driver': 'GV13', 'value': 0, 'uom': 56, 'name': 'Temperature Trend'},
+               {'driver': 'GV14', 'value': 0, 'uom': 56, 'name': 'Voltage Trend'}]
     
     id = 'FLAIR_VENT'
     commands = { 'SET_OPEN' : setOpen,
                  'QUERY': query}
     
-class FlairPuck(udi_interface.Node):
+class FlairPuck(FlairNode):
 
     def __init__(self, controller, primary, address, name, puck,room):
 
@@ -401,16 +1077,34 @@ class FlairPuck(udi_interface.Node):
         self.name = name
         self.objPuck = puck
         self.objRoom = room
+        self.reading = None
+        self.readingAt = None
+        # Address of the structure node whose fetch hands us readings,
+        # and whether the last update used one, see PollScheduler.
+        self.supplier = None
+        self.supplied = False
         
     def query(self):
         self.reportDrivers()
+
+    def setReading(self, puck, reading, supplier=None):
+        self.objPuck = puck
+        self.reading = reading
+        self.supplier = supplier
+
+    def getReading(self):
+        reading, self.reading = self.reading, None
+        self.supplied = reading is not None
+        if reading is None:
+            reading = self.objPuck.get_rel('current-reading')
+        return reading
     
     def update(self):
         try:
             if  self.objPuck.attributes['inactive'] is True:
-                self.setDriver('GV2', 1)
+                self.publish('GV2', 1)
             else:
-                self.setDriver('GV2', 0)
+                self.publish('GV2', 0)
 
             #LOGGER.debug('puck attributes: {}'.format(self.objPuck.attributes))
             #tempC = float(self.objPuck.attributes['current-temperature-c'])  if self.objPuck.attributes['current-temperature-c'] != None else 0 
@@ -418,7 +1112,7 @@ class FlairPuck(udi_interface.Node):
                 
             
             # Get current-reading
-            creading = self.objPuck.get_rel('current-reading')
+            creading = self.getReading()
             cat = creading.attributes
             LOGGER.debug('PUCK raw = {}'.format(cat))
 
@@ -431,28 +1125,40 @@ class FlairPuck(udi_interface.Node):
 
             LOGGER.info('PUCK: {} - {} / {} -- {}  {} {} {}'.format(self.name, tempC, tempF, cat['created-at'], cat['humidity'], cat['rssi'], cat['system-voltage']))
 
-            self.setDriver('CLITEMP', round(tempC,1))
-            self.setDriver('GV7', round(tempF,1))
-            self.setDriver('CLIHUM', cat['humidity'])
-            self.setDriver('GV12', cat['rssi'])
-            self.setDriver('GV8', cat['system-voltage'])
+            self.readingAt = parse_timestamp(cat['created-at'])
+            self.publish('CLITEMP', round(tempC,1))
+            self.publish('GV7', round(tempF,1))
+            self.publish('CLIHUM', cat['humidity'])
+            self.publish('GV12', cat['rssi'])
+            self.publish('GV8', cat['system-voltage'])
+
+            self.record(self.readingAt, {'temperature': cat.get('room-temperature-c'),
+                                         'humidity': cat['humidity'],
+                                         'voltage': cat['system-voltage'],
+                                         'rssi': cat['rssi']})
+            self.publishTrend('GV13', 'temperature', self.trend_window, 3600)
+            self.publishTrend('GV14', 'voltage', None, 86400)
                
         except ApiError as ex:
             LOGGER.error('Error query: %s', str(ex))  
+            self.discardDrivers()
         except Exception as err:
             LOGGER.error('Error puck update: %s', str(err))
+            self.discardDrivers()
             
     drivers = [ {'driver': 'GV2', 'value': 0, 'uom': 2, 'name': 'Status'},
                {'driver': 'CLITEMP', 'value': 0, 'uom': 4, 'name': 'Temperature C'},
                {'driver': 'CLIHUM', 'value': 0, 'uom': 51, 'name': 'Humidity'},
                {'driver': 'GV7', 'value': 0, 'uom': 17, 'name': 'Temperature F'},
                {'driver': 'GV8', 'value': 0, 'uom': 72, 'name': 'Voltage'},
-               {'driver': 'GV12', 'value': 0, 'uom': 56, 'name': 'rssi'}]
+               {'driver': 'GV12', 'value': 0, 'uom': 56, 'name': 'rssi'},
+               {'driver': 'GV13', 'value': 0, 'uom': 56, 'name': 'Temperature Trend'},
+               {'driver': 'GV14', 'value': 0, 'uom': 56, 'name': 'Voltage Trend'}]
     
     id = 'FLAIR_PUCK'
     commands = {  'QUERY': query }
 
-class FlairRoom(udi_interface.Node):
+class FlairRoom(FlairNode):
 
     def __init__(self, controller, primary, address, name,room):
 
@@ -467,30 +1173,40 @@ class FlairRoom(udi_interface.Node):
     def new_update(self, tempC, humidity, setpoint):
         try:
             if self.objRoom.attributes['active'] is True:
-                self.setDriver('GV2', 0)
+                self.publish('GV2', 0)
             else:
-                self.setDriver('GV2', 1)
+                self.publish('GV2', 1)
 
             LOGGER.info('ROOM: {} {} / {} / {}'.format(self.name, tempC, humidity, setpoint))
 
             if tempC is not None:
                 tempF = (tempC * 9/5) + 32
-                self.setDriver('CLITEMP', round(tempC,1))
-                self.setDriver('GV7',round(tempF,1))
+                self.publish('CLITEMP', round(tempC,1))
+                self.publish('GV7',round(tempF,1))
             if humidity is None:
-                self.setDriver('CLIHUM',0)
+                self.publish('CLIHUM',0)
             else:
-                self.setDriver('CLIHUM', humidity)
+                self.publish('CLIHUM', humidity)
 
             if setpoint is not None:
-                self.setDriver('CLISPC', round(setpoint,1))
+                self.publish('CLISPC', round(setpoint,1))
             else:
-                self.setDriver('CLISPC', 0)
+                self.publish('CLISPC', 0)
         except Exception as err:
             LOGGER.error('Error room update: %s', str(err))
+            self.discardDrivers()
 
     def update(self):
-        LOGGER.debug('update not implemented this way')
+        '''
+        Only used when rooms have a poll interval of their own, otherwise
+        the structure refreshes them through new_update().
+        '''
+        try:
+            self.objRoom.get_self()
+            self.new_update(self.objRoom.attributes['current-temperature-c'], self.objRoom.attributes['current-humidity'], self.objRoom.attributes['set-point-c'])
+        except ApiError as ex:
+            LOGGER.error('Error query: %s', str(ex))
+            self.discardDrivers()
 
     def old_update(self):
         '''
@@ -531,12 +1247,9 @@ class FlairRoom(udi_interface.Node):
             LOGGER.error('Error room update: %s', str(err))
     
     def setTemp(self, command):
-        try:
-            self.objRoom.update(attributes={'set-point-c': command.get('value')})
-            self.setDriver('CLISPC', round(self.objRoom.attributes['set-point-c'],1))
-
-        except ApiError as ex:
-            LOGGER.error('Error setTemp: %s', str(ex))
+        value = float(command.get('value'))
+        self.write(self.objRoom, {'set-point-c': value}, 'CLISPC', round(value,1),
+                   lambda attributes: round(attributes['set-point-c'],1))
 
     drivers = [ {'driver': 'GV2', 'value': 0, 'uom': 2, 'name': 'Status'},
                {'driver': 'CLITEMP', 'value': 0, 'uom': 4, 'name': 'Temperature C'},
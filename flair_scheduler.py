@@ -0,0 +1,136 @@
+import random
+import threading
+import time
+import udi_interface
+
+LOGGER = udi_interface.LOGGER
+
+# Poll intervals in seconds per node definition, 0 means the node is only
+# refreshed through its structure.
+DEFAULT_INTERVALS = {
+    'FLAIR_STRUCT': 90,
+    'FLAIR_ROOM': 0,
+    'FLAIR_VENT': 90,
+    'FLAIR_PUCK': 90
+}
+
+INITIAL_SPREAD = 30
+MIN_DELAY = 5
+CADENCE_WEIGHT = 0.3
+
+
+class PollScheduler(object):
+    '''
+    Refreshes each node on the interval of its class instead of on the
+    shared shortPoll tick.  Start times are spread across the interval so
+    the requests don't burst, and for nodes that expose the created-at of
+    their last reading (readingAt) the scheduler learns how often the
+    device reports and fetches just after the next reading is expected.
+    A node whose last update used a reading handed over by another node
+    (supplied, from supplier) is not due again before that node's next
+    run, so it is not fetched on its own while the supplier covers it.
+    '''
+    def __init__(self, nodes, run, intervals=DEFAULT_INTERVALS,
+                 slack=MIN_DELAY, jitter=0.1, paused=None):
+        self.nodes = nodes
+        self.run = run
+        self.intervals = dict(intervals)
+        self.slack = slack
+        self.jitter = jitter
+        self.paused = paused
+        self.due = {}
+        self.cadence = {}
+        self.last_reading = {}
+        self.wake = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.wake.clear()
+        self.thread = threading.Thread(target=self._loop, name='scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.thread = None
+        self.wake.set()
+
+    def interval(self, node):
+        return self.intervals.get(node.id, 0)
+
+    def scheduled(self, node):
+        '''
+        A node runs when its time has come, or right away when its
+        structure already handed it a reading that only needs publishing.
+        '''
+        if getattr(node, 'reading', None) is not None:
+            return True
+        if self.interval(node) <= 0:
+            self.due.pop(node.address, None)
+            return False
+        due = self.due.get(node.address)
+        if due is None:
+            due = time.monotonic() + random.uniform(0, min(self.interval(node), INITIAL_SPREAD))
+            self.due[node.address] = due
+        return due <= time.monotonic()
+
+    def next_delay(self, node):
+        interval = self.interval(node)
+        fixed = interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        created = getattr(node, 'readingAt', None)
+        if created is None:
+            return fixed
+
+        last = self.last_reading.get(node.address)
+        if last is None or created > last:
+            if last is not None:
+                cadence = self.cadence.get(node.address)
+                delta = created - last
+                self.cadence[node.address] = delta if cadence is None else \
+                    cadence + CADENCE_WEIGHT * (delta - cadence)
+            self.last_reading[node.address] = created
+
+        cadence = self.cadence.get(node.address)
+        if cadence is None:
+            return fixed
+
+        now = time.time()
+        if now - created > 2 * cadence:
+            # The device has stopped reporting, don't chase it.
+            return fixed
+        delay = created + cadence + self.slack - now
+        if delay < self.slack:
+            # Expected reading not there yet, look again shortly.
+            delay = max(self.slack, cadence / 4)
+        return min(delay, fixed)
+
+    def defer(self, node):
+        '''
+        Push the node's due time past its supplier's next run when the
+        supplier handed it its last reading.
+        '''
+        supplier = getattr(node, 'supplier', None)
+        if not getattr(node, 'supplied', False) or supplier not in self.due or node.address not in self.due:
+            return
+        self.due[node.address] = max(self.due[node.address], self.due[supplier] + self.slack)
+
+    def _loop(self):
+        thread = self.thread
+        while self.thread is thread:
+            try:
+                if self.paused is None or not self.paused():
+                    nodes = [node for node in self.nodes() if self.scheduled(node)]
+                    # run() returns False when it skipped the nodes, they
+                    # stay due and are tried again on the next pass.
+                    if nodes and self.run(nodes) is not False:
+                        for node in nodes:
+                            if self.interval(node) > 0:
+                                self.due[node.address] = time.monotonic() + self.next_delay(node)
+                        for node in nodes:
+                            self.defer(node)
+            except Exception as ex:
+                LOGGER.error('Error scheduler: %s', str(ex))
+
+            upcoming = list(self.due.values())
+            wait = min(upcoming) - time.monotonic() if upcoming else 1
+            self.wake.wait(min(max(wait, 1), 10))
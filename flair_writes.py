@@ -0,0 +1,105 @@
+import threading
+import time
+import udi_interface
+from concurrent.futures import ThreadPoolExecutor
+from flair_api import interactive
+
+LOGGER = udi_interface.LOGGER
+
+DEFAULT_WRITE_DELAY = 1.0
+# A resource that keeps getting commands is still written this often.
+MAX_DELAY_FACTOR = 4
+
+
+class PendingWrite(object):
+    __slots__ = ('resource', 'attributes', 'callbacks', 'deadline', 'timer')
+
+    def __init__(self, resource, deadline):
+        self.resource = resource
+        self.attributes = {}
+        self.callbacks = []
+        self.deadline = deadline
+        self.timer = None
+
+
+class WriteCoalescer(object):
+    '''
+    Holds attribute writes per Flair resource for delay seconds after the
+    last command, so a burst of commands to the same resource becomes one
+    PATCH carrying the final values.  After the write each callback gets
+    the updated resource, or the exception if it failed: an ApiError when
+    Flair refused it, a requests error when it timed out or could not
+    connect.  Writes are sent as interactive requests, ahead of any queued
+    polling.  With a delay of 0 writes go out right away, on a background
+    worker in optimistic mode and on the caller's thread otherwise.
+    '''
+    def __init__(self, delay=DEFAULT_WRITE_DELAY, optimistic=True):
+        self.delay = delay
+        self.optimistic = optimistic
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def write(self, resource, attributes, callback=None):
+        if self.delay <= 0:
+            callbacks = [callback] if callback else []
+            if self.optimistic:
+                self._executor().submit(self._send, resource, attributes, callbacks)
+            else:
+                self._send(resource, attributes, callbacks)
+            return
+
+        key = (resource.type_, resource.id_)
+        now = time.monotonic()
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending is None:
+                pending = self.pending[key] = PendingWrite(resource, now + self.delay * MAX_DELAY_FACTOR)
+            elif pending.timer is not None:
+                pending.timer.cancel()
+            pending.attributes.update(attributes)
+            if callback is not None:
+                pending.callbacks.append(callback)
+            wait = max(0, min(self.delay, pending.deadline - now))
+            pending.timer = threading.Timer(wait, self.flush, args=(key,))
+            pending.timer.daemon = True
+            pending.timer.start()
+
+    def _executor(self):
+        # One worker, so writes land in the order the commands came in.
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='write')
+            return self.executor
+
+    def flush(self, key):
+        with self.lock:
+            pending = self.pending.pop(key, None)
+        if pending is not None:
+            self._send(pending.resource, pending.attributes, pending.callbacks)
+
+    def flush_all(self):
+        with self.lock:
+            keys = list(self.pending)
+            for key in keys:
+                if self.pending[key].timer is not None:
+                    self.pending[key].timer.cancel()
+        for key in keys:
+            self.flush(key)
+
+    def _send(self, resource, attributes, callbacks):
+        LOGGER.debug('Writing {} {}: {}'.format(resource.type_, resource.id_, attributes))
+        try:
+            with interactive():
+                resource.update(attributes=attributes)
+            result = resource
+        except Exception as ex:
+            # Every callback hears back, whatever went wrong, so nodes
+            # don't wait on a write that will never land.
+            LOGGER.error('Error writing {} {}: {}'.format(resource.type_, resource.id_, str(ex)))
+            result = ex
+        for callback in callbacks:
+            try:
+                callback(result)
+            except Exception as ex:
+                LOGGER.error('Error after writing {} {}: {}'.format(resource.type_, resource.id_, str(ex)))
@@ -0,0 +1,48 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flair_drivers import DriverBatch
+from flair_drivers import batching
+from test_writes import Node
+from test_writes import Poly
+from test_writes import Vent
+from flair_writes import WriteCoalescer
+
+
+class DriverBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.poly = Poly()
+        self.node = Node(self.poly, 'controller', 'v1', 'Vent')
+        self.node.writes = WriteCoalescer(delay=0)
+
+    def test_one_message_per_flush(self):
+        batch = DriverBatch()
+        with batching(batch):
+            self.node.publish('GV1', 20)
+        self.assertEqual(self.poly.sent, [])
+        self.assertEqual(batch.flush(), 1)
+        self.assertEqual(self.poly.sent[0]['set'][0]['value'], '20')
+
+    def test_text_is_reported(self):
+        batch = DriverBatch()
+        with batching(batch):
+            self.node.setDriver('GV1', 10, text='Closed')
+        self.assertEqual(batch.flush(), 1)
+        self.assertEqual(self.poly.sent[0]['set'][0]['text'], 'Closed')
+
+    def test_reading_staged_before_command_is_dropped(self):
+        batch = DriverBatch()
+        with batching(batch):
+            self.node.publish('GV1', 20)
+        self.node.write(Vent(), {'percent-open': 50}, 'GV1', 50,
+                        lambda attributes: attributes['percent-open'])
+        self.node.writes._executor().submit(lambda: None).result()
+        self.assertEqual(batch.flush(), 0)
+        self.assertEqual(self.node.getDriver('GV1'), 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
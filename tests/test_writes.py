@@ -0,0 +1,80 @@
+import os
+import sys
+import unittest
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flair_poly import FlairNode
+from flair_writes import WriteCoalescer
+
+
+class Notices(dict):
+    def delete(self, key):
+        self.pop(key, None)
+
+
+class Poly(object):
+    def __init__(self):
+        self.Notices = Notices()
+        self.sent = []
+
+    def db_getNodeDrivers(self, address):
+        return []
+
+    def send(self, message, kind):
+        self.sent.append(message)
+
+
+class Vent(object):
+    type_ = 'vents'
+    id_ = '1'
+
+    def __init__(self, error=None):
+        self.attributes = {'percent-open': 10}
+        self.error = error
+
+    def update(self, attributes):
+        if self.error is not None:
+            raise self.error
+        self.attributes = dict(self.attributes, **attributes)
+
+
+class Node(FlairNode):
+    drivers = [{'driver': 'GV1', 'value': 10, 'uom': 51}]
+
+
+class OptimisticWriteTest(unittest.TestCase):
+    def setUp(self):
+        self.poly = Poly()
+        self.node = Node(self.poly, 'controller', 'v1', 'Vent')
+        self.node.writes = WriteCoalescer(delay=0)
+
+    def open(self, vent, value):
+        self.node.write(vent, {'percent-open': value}, 'GV1', value,
+                        lambda attributes: attributes['percent-open'])
+        # One write worker, so this returns once the write has settled.
+        self.node.writes._executor().submit(lambda: None).result()
+
+    def test_landed_write_is_kept(self):
+        self.open(Vent(), 50)
+        self.assertEqual(self.node.getDriver('GV1'), 50)
+        self.assertEqual(self.node.writing, {})
+
+    def test_timed_out_write_rolls_back(self):
+        self.open(Vent(requests.Timeout('read timed out')), 50)
+        self.assertEqual(self.node.getDriver('GV1'), 10)
+        self.assertEqual(self.node.writing, {})
+        self.assertIn('write_v1', self.poly.Notices)
+        # Readings are published again once nothing is being written.
+        self.assertTrue(self.node.publish('GV1', 20))
+
+    def test_landed_write_clears_notice(self):
+        self.open(Vent(requests.Timeout('read timed out')), 50)
+        self.open(Vent(), 50)
+        self.assertNotIn('write_v1', self.poly.Notices)
+
+
+if __name__ == '__main__':
+    unittest.main()